@@ -83,6 +83,13 @@ module minimizer_wrappers
     public do_get_cached_traces_memory
     public do_set_cached_traces_memory_limit
     public do_set_verbose
+    public do_set_answer_format
+    public put_binary_answer
+
+  ! binary answer mode, see set_answer_format
+    integer, save :: g_binary_unit = 0
+    logical, save :: g_binary_answers = .false.
+    real(kind=8), dimension(:), allocatable, save :: g_binary_answer
 
   contains
   
@@ -310,6 +317,47 @@ module minimizer_wrappers
         call switch_receiver( ireceiver, state, ok )
 
     end subroutine
+
+    subroutine do_switch_receivers( line, answer, ok )
+
+     !! === {{{switch_receivers states}}} ===
+      !
+      ! Turn all receivers on or off at once.
+      !
+      ! {{{states}}} is a string with one character per receiver, {{{1}}} to turn
+      ! the receiver on, {{{0}}} to turn it off, e.g. {{{switch_receivers 1101}}}.
+
+        type(varying_string), intent(in)  :: line
+        type(varying_string), intent(out) :: answer
+        logical, intent(out)              :: ok
+        
+        character(len=len(line)) :: buffer
+        logical, dimension(:), allocatable :: states
+        integer :: i, n
+
+        answer = ''
+        ok = .true.
+
+        buffer = adjustl(char(line))
+        n = len_trim(buffer)
+        allocate( states(n) )
+        do i=1,n
+            if (buffer(i:i) == '1') then
+                states(i) = .true.
+            else if (buffer(i:i) == '0') then
+                states(i) = .false.
+            else
+                call error( "usage: switch_receivers states" )
+                ok = .false.
+                deallocate( states )
+                return
+            end if
+        end do
+    
+        call switch_receivers( states, ok )
+        deallocate( states )
+
+    end subroutine
     
     subroutine do_set_ref_seismograms( line, answer, ok )
       
@@ -438,7 +486,7 @@ module minimizer_wrappers
         call get_floating_shifts( shifts_, ok )
         if (.not. ok) return
      
-        call array_to_string( shifts_, answer )
+        call values_to_answer( shifts_, answer )
         if (allocated( shifts_)) deallocate(shifts_)
 
     end subroutine
@@ -1260,6 +1308,25 @@ module minimizer_wrappers
     
     end subroutine
 
+    subroutine values_to_answer( array, answer )
+
+      ! Put values into answer string, or into the binary answer buffer
+      ! if binary answers are turned on.
+    
+        real, dimension(:), intent(in) :: array
+        type(varying_string), intent(out) :: answer
+
+        if (g_binary_answers) then
+            if (allocated(g_binary_answer)) deallocate(g_binary_answer)
+            allocate(g_binary_answer(size(array)))
+            g_binary_answer(:) = array(:)
+            answer = ''
+        else
+            call array_to_string( array, answer )
+        end if
+
+    end subroutine
+
     subroutine array2d_to_string( array, string )
     
         real, dimension(:,:), intent(in) :: array
@@ -1297,7 +1364,7 @@ module minimizer_wrappers
         call get_misfits( misfits_, ok )
         if (.not. ok) return
      
-        call array2d_to_string( misfits_, answer )
+        call values_to_answer( reshape(misfits_, (/size(misfits_)/)), answer )
         if (allocated( misfits_)) deallocate(misfits_)
         
     end subroutine
@@ -1337,7 +1404,7 @@ module minimizer_wrappers
         call get_peak_amplitudes( differentiate, maxabs_, ok )
         if (.not. ok) return
      
-        call array2d_to_string( maxabs_, answer )
+        call values_to_answer( reshape(maxabs_, (/size(maxabs_)/)), answer )
         if (allocated(maxabs_)) deallocate(maxabs_)
         
     end subroutine
@@ -1366,7 +1433,7 @@ module minimizer_wrappers
         call get_arias_intensities( intensities, ok )
         if (.not. ok) return
      
-        call array_to_string( intensities, answer )
+        call values_to_answer( intensities, answer )
         if (allocated(intensities)) deallocate(intensities)
         
     end subroutine
@@ -1568,6 +1635,64 @@ module minimizer_wrappers
 
     end subroutine
 
+    subroutine do_set_answer_format( line, answer, ok )
+
+     !! === {{{set_answer_format (text|binary)}}} ===
+      !
+      ! Select how the answers of {{{get_misfits}}}, {{{get_floating_shifts}}},
+      ! {{{get_peak_amplitudes}}} and {{{get_arias_intensities}}} are sent.
+      !
+      ! With {{{text}}} (default), the values are printed on the line following
+      ! the {{{ok >}}} status line.
+      !
+      ! With {{{binary}}}, the status line reads {{{ok b}}} and is followed by
+      ! the number of values as 4 byte little-endian integer and the values as
+      ! little-endian 8 byte floating point numbers, without newline.
+
+        type(varying_string), intent(in)  :: line
+        type(varying_string), intent(out) :: answer
+        logical, intent(out)              :: ok
+
+        integer :: iostat
+        
+        answer = ''
+        ok = .true.
+        
+        if (line == 'text') then
+            g_binary_answers = .false.
+        else if (line == 'binary') then
+            if (g_binary_unit == 0) then
+                call claim_unit( g_binary_unit )
+                open( unit=g_binary_unit, file='/dev/stdout', access='stream', &
+                      form='unformatted', status='old', action='write', &
+                      convert='little_endian', iostat=iostat )
+                if (iostat /= 0) then
+                    call release_unit( g_binary_unit )
+                    g_binary_unit = 0
+                    call error("set_answer_format: cannot open stdout for binary output")
+                    ok = .false.
+                    return
+                end if
+            end if
+            g_binary_answers = .true.
+        else 
+            call error("usage: set_answer_format (text|binary)")
+            ok = .false.
+        end if
+
+    end subroutine
+
+    subroutine put_binary_answer()
+
+      ! Write pending binary answer to stdout and clear it.
+
+        call flush( stdout )
+        write (g_binary_unit) int(size(g_binary_answer),4), g_binary_answer
+        flush( g_binary_unit )
+        deallocate( g_binary_answer )
+
+    end subroutine
+
     subroutine ignore_sig()
     end subroutine
 
@@ -1689,7 +1814,10 @@ program minimizer
         
         call do_command( line, answer, command, ok )
         if (ok) then
-            if (answer == '') then
+            if (allocated(g_binary_answer)) then
+                call put_line(command // ": ok b")
+                call put_binary_answer()
+            else if (answer == '') then
                 call put_line(command // ": ok")
             else
                 call put_line(command // ": ok >")
@@ -1704,6 +1832,7 @@ program minimizer
                 call error("")
             end if
         end if
+        if (allocated(g_binary_answer)) deallocate(g_binary_answer)
 
         call flush( stdout )
         
@@ -1745,6 +1874,8 @@ program minimizer
             call do_set_receivers( arguments, answer, ok )
         else if (command == 'switch_receiver') then
             call do_switch_receiver( arguments, answer, ok )
+        else if (command == 'switch_receivers') then
+            call do_switch_receivers( arguments, answer, ok )
         else if (command == 'set_ref_seismograms') then
             call do_set_ref_seismograms( arguments, answer, ok )
         else if (command == 'shift_ref_seismogram') then
@@ -1815,6 +1946,8 @@ program minimizer
             call do_set_verbose( arguments, answer, ok )
         else if (command == 'set_ignore_sigint') then
             call do_set_ignore_sigint(arguments, answer, ok )
+        else if (command == 'set_answer_format') then
+            call do_set_answer_format(arguments, answer, ok )
         else
             call error("unknown command: "//command)
         end if
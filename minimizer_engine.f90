@@ -51,6 +51,7 @@ module minimizer_engine
     public set_effective_dt
     public set_receivers
     public switch_receiver
+    public switch_receivers
     public set_misfit_method
     public set_misfit_filter
     public set_misfit_taper
@@ -309,6 +310,30 @@ module minimizer_engine
         call dirtyfy_receivers()
 
     end subroutine
+
+    subroutine switch_receivers( newstates, ok )
+
+        logical, dimension(:), intent(in) :: newstates
+        logical, intent(out) :: ok
+
+        integer :: ireceiver
+
+        call update_receivers( ok )
+        if (.not. ok) return
+
+        if (size(newstates) /= size(receivers)) then
+            ok = .false.
+            call error( 'number of receiver states does not match number of receivers' )
+            return
+        end if
+
+        do ireceiver=1,size(receivers)
+            call receiver_set_enabled( receivers(ireceiver), newstates(ireceiver) )
+        end do
+
+        call dirtyfy_receivers()
+
+    end subroutine
     
     subroutine set_ref_seismograms( reffnbase, refformat, ok )
     
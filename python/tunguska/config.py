@@ -13,6 +13,13 @@ default_loglevel = logging.INFO
 
 exit_on_fatal = True
 
+# how often a seismosizer process may be respawned while executing a command
+seismosizer_max_respawns = 3
+
+# how many seconds to wait for an answer of a seismosizer process, before it
+# is considered hung and respawned (None: wait forever)
+seismosizer_timeout = None
+
 source_info_prog = 'source_info'
 gfdb_info_prog = 'gfdb_info'
 gfdb_extract_prog = 'gfdb_extract'
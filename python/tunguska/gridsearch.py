@@ -1,13 +1,16 @@
 import config
 import plotting
 import seismosizer
+import source as source_model
 import util
 import logging
 
-import re, copy
+import re, copy, os, shutil
+import cPickle as pickle
 import progressbar 
 import numpy as num
 import scipy.stats
+import scipy.interpolate
 from os.path import join as pjoin
 
 def numpy_version():
@@ -108,14 +111,63 @@ class MisfitGridStats:
         return MisfitGridStats(paramname, best, distribution, tested_values=tested_values)
 
 
+class StoredArray:
+    '''Reference to an array in a .npy file, which is memory-mapped when loaded.'''
+    
+    def __init__(self, filename):
+        self.filename = filename
+        
+    def load(self, dirname=None):
+        filename = self.filename
+        if dirname is not None:
+            filename = pjoin(dirname, os.path.basename(filename))
+        
+        if not os.path.exists(filename):
+            raise Exception('array file of grid search is missing: %s' % filename)
+        
+        return num.load(filename, mmap_mode='r')
+
 class MisfitGrid:
     '''Brute force grid search minimizer with builtin bootstrapping.'''
     
+    # number of sources between two checkpoints, see compute()
+    checkpoint_block_size = 1000
+    
+    # number of (source, iteration) pairs handled at once by _bootstrap()
+    bootstrap_chunk_size = 2**22
+    
+    # arrays which may be memory-mapped, see compute()
+    stored_arrays = ('misfits_by_src', 'norms_by_src')
+    
     def __init__( self, base_source,
                         param_ranges=None,
                         param_values=None,
                         source_constraints=None,
-                        ref_source=None):
+                        ref_source=None,
+                        refine_levels=0,
+                        refine_nbest=8,
+                        prune_margin=None,
+                        nsamples=None,
+                        sampling='sobol',
+                        sampling_seed=None):
+        '''Set up grid search over given parameter values or ranges.
+        
+        With nsamples set, the full grid is not searched. Instead, nsamples
+        sources are drawn between the smallest and largest value of each
+        parameter, with the sampling method given (see
+        source.Source.randomize()). The grid values are then only used as
+        bins in the statistics and plots.
+        
+        With refine_levels > 0, the grid is searched adaptively: compute()
+        starts with every 2**refine_levels-th value of each parameter and
+        then, for each level, adds the nodes around the refine_nbest best
+        nodes at half the previous spacing. All nodes lie on the full grid,
+        but only the evaluated ones end up in sources.
+        
+        With prune_margin set, compute() does not complete sources which are
+        clearly worse than the best ones (see 
+        seismosizer.Seismosizer.make_misfits_for_sources()). Their misfits
+        are NaN and they are ignored by the statistics.'''
         
         self.base_source = copy.deepcopy(base_source)
         if ref_source:
@@ -133,10 +185,36 @@ class MisfitGrid:
             for param, mi, ma, inc in param_ranges:
                 self.param_values.append( (param, mimainc_to_gvals(mi,ma,inc)) )
             
-        self.sources = self.base_source.grid( self.param_values, 
-                                              source_constraints=source_constraints)
-
         self.sourceparams = [ x[0] for x in self.param_values ]
+        self.source_constraints = source_constraints
+        self.refine_levels = refine_levels
+        self.refine_nbest = refine_nbest
+        self.prune_margin = prune_margin
+        self.nsamples = nsamples
+        self.sampling = sampling
+        
+        # a source.SourceGrid
+        if nsamples is not None:
+            if self.refine_levels > 0:
+                raise Exception('refine_levels cannot be combined with nsamples')
+            
+            sourceparams = [ (param, num.min(gvalues), num.max(gvalues)) 
+                             for (param, gvalues) in self.param_values ]
+            
+            self.sources = self.base_source.randomize(sourceparams, nsamples, 
+                                                      method=sampling, seed=sampling_seed)
+            if source_constraints is not None:
+                self.sources = self.sources.take(num.nonzero(self.sources.mask(source_constraints))[0])
+                
+            self.grid_indices = None
+            
+        elif self.refine_levels > 0 and self.param_values:
+            # indices of the sources into the param values
+            self.sources, self.grid_indices = self._grid_sources(self._coarse_grid_indices())
+        else:
+            self.sources = self.base_source.grid( self.param_values, 
+                                                  source_constraints=source_constraints)
+            self.grid_indices = None
 
         # will be set by compute()
         self.misfits_by_src = None
@@ -156,8 +234,61 @@ class MisfitGrid:
         self.bootstrap_sources = None
         self.stats = None
         
-    def compute(self, seis):
-        '''Let seismosizer calculate the trace misfits.'''
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # callbacks may not be picklable
+        state['source_constraints'] = None
+        for name in self.stored_arrays:
+            if isinstance(state.get(name), num.memmap):
+                state[name] = StoredArray(state[name].filename)
+                
+        return state
+    
+    def __setstate__(self, state):
+        # the arrays are opened by attach_storage(), because their files may
+        # have moved along with the run directory
+        self.__dict__.update(state)
+        
+    def attach_storage(self, dirname=None):
+        '''Open memory-mapped arrays of misfits and norms.
+        
+        The files are looked for in dirname, if given, or where they have
+        been written to, otherwise. Raises an exception if a file is missing.'''
+        
+        for name in self.stored_arrays:
+            array = self.__dict__.get(name)
+            if isinstance(array, num.memmap):
+                array = StoredArray(array.filename)
+            
+            if isinstance(array, StoredArray):
+                self.__dict__[name] = array.load(dirname)
+    
+    def copy_storage(self, dirname):
+        '''Copy memory-mapped arrays into dirname, unless they are there already.'''
+        
+        for name in self.stored_arrays:
+            array = self.__dict__.get(name)
+            if isinstance(array, num.memmap):
+                if os.path.dirname(os.path.abspath(array.filename)) != os.path.abspath(dirname):
+                    shutil.copy(array.filename, dirname)
+                    
+        self.attach_storage(dirname)
+        
+    def compute(self, seis, checkpoint=None, storage=None, storage_dtype=num.float, **outer_misfit_config):
+        '''Let seismosizer calculate the trace misfits.
+        
+        If a checkpoint filename is given, the results are appended to this
+        file in blocks of checkpoint_block_size sources, and a computation
+        which has been interrupted is resumed after the last block found in
+        it.
+        
+        If storage is given, misfits and norms are kept in memory-mapped 
+        files storage+'-misfits_by_src.npy' and storage+'-norms_by_src.npy'.
+        These are referenced, not included, when the grid is pickled. The
+        results are stored as storage_dtype, e.g. num.float32 to save space.
+        
+        The outer misfit config is used to select the best nodes, when the
+        grid is refined adaptively, and to prune sources.'''
         
         if len(self.sourceparams) == 1:
             progress_title = 'Grid search param: ' + ', '.join(self.sourceparams)
@@ -168,11 +299,25 @@ class MisfitGrid:
         nreceivers_enabled = len( [ rec for rec in seis.receivers if rec.enabled ] )
         receiver_mask = num.array( [ rec.enabled for rec in seis.receivers ], dtype=num.bool )
         
+        misfit_config = dict(outer_misfit_config)
+        if self.prune_margin is not None:
+            misfit_config['prune_margin'] = self.prune_margin
+        
+        ncomponents = max([ len(r.components) for r in seis.receivers ])
+        
         # results, gathered by (source,receiver,component)
-        misfits_by_src, norms_by_src, failings = seis.make_misfits_for_sources( 
-                                                    self.sources,
-                                                    show_progress=config.show_progress,
-                                                    progress_title=progress_title)
+        if self._is_adaptive():
+            misfits_by_src, norms_by_src = self._compute_adaptive(seis, checkpoint, progress_title,
+                                                                 receiver_mask, misfit_config, 
+                                                                 storage, storage_dtype)
+        else:
+            out = self._allocate((len(self.sources), nreceivers, ncomponents), storage, storage_dtype)
+            misfits_by_src, norms_by_src, failings = self._compute_sources(seis, self.sources, checkpoint, 
+                                                                           progress_title, misfit_config, out=out)
+        
+        for array in misfits_by_src, norms_by_src:
+            if isinstance(array, num.memmap):
+                array.flush()
               
         # results for reference source, gathered by (source,receiver,component)
         ref_misfits_by_src, ref_norms_by_src, failings = seis.make_misfits_for_sources([self.ref_source])
@@ -196,6 +341,308 @@ class MisfitGrid:
         self.bootstrap_sources = None
         self.stats = None
     
+    def _compute_sources(self, seis, sources, checkpoint, progress_title, misfit_config, out=None):
+        if checkpoint is None and out is None:
+            misfits_by_src, norms_by_src, failings = seis.make_misfits_for_sources( 
+                                                        sources,
+                                                        show_progress=config.show_progress,
+                                                        progress_title=progress_title,
+                                                        **misfit_config)
+        else:
+            misfits_by_src, norms_by_src, failings = self._compute_blocks(
+                                                        seis, sources, checkpoint, progress_title, 
+                                                        misfit_config, out=out)
+            
+        return misfits_by_src, norms_by_src, failings
+    
+    def _global_misfits(self, misfits_by_src, norms_by_src, failings, receiver_mask, misfit_config):
+        '''Global misfits to choose sources by, NaN where undefined or failing.
+        
+        Evaluated in blocks, so that memory-mapped arrays are not loaded 
+        completely.'''
+        
+        nsources = misfits_by_src.shape[0]
+        misfits_by_s = num.zeros(nsources, dtype=num.float)
+        for istart in xrange(0, nsources, self.checkpoint_block_size):
+            iend = min(istart+self.checkpoint_block_size, nsources)
+            misfits_by_s[istart:iend] = seismosizer.make_global_misfits(
+                misfits_by_src[istart:iend], norms_by_src[istart:iend], 
+                receiver_mask=receiver_mask, **misfit_config)[0]
+        
+        misfits_by_s = num.where(misfits_by_s > 0., misfits_by_s, num.NaN)
+        misfits_by_s[failings] = num.NaN
+        return misfits_by_s
+    
+    def _allocate(self, shape, storage, dtype):
+        '''Get arrays for misfits and norms, memory-mapped if storage is set.'''
+        
+        if dtype == num.float and storage is None:
+            return None
+        
+        arrays = []
+        for name in self.stored_arrays:
+            if storage is None:
+                arrays.append(num.zeros(shape, dtype=dtype))
+            else:
+                arrays.append(num.lib.format.open_memmap('%s-%s.npy' % (storage, name), 
+                                                         mode='w+', dtype=dtype, shape=shape))
+        
+        return arrays
+    
+    def _allocate_scratch(self, seis, nmax, storage, dtype):
+        '''Get arrays with room for the results of up to nmax sources.
+        
+        The adaptive searches fill them in as they go. With storage set, 
+        they are memory-mapped temporary files, see _finish_scratch().'''
+        
+        ncomponents = max([ len(r.components) for r in seis.receivers ])
+        shape = (nmax, len(seis.receivers), ncomponents)
+        arrays = []
+        for name in self.stored_arrays:
+            if storage is None:
+                arrays.append(num.zeros(shape, dtype=dtype))
+            else:
+                arrays.append(num.lib.format.open_memmap('%s-%s.tmp.npy' % (storage, name), 
+                                                         mode='w+', dtype=dtype, shape=shape))
+        
+        return arrays
+    
+    def _finish_scratch(self, scratch, order, storage, dtype):
+        '''Get the rows of the scratch arrays given by order, as final arrays.
+        
+        The rows are copied block by block and temporary files are removed.'''
+        
+        if storage is None:
+            return [ array[order] for array in scratch ]
+        
+        out = self._allocate((len(order),) + scratch[0].shape[1:], storage, dtype)
+        for array, array_out in zip(scratch, out):
+            for istart in xrange(0, len(order), self.checkpoint_block_size):
+                iend = min(istart+self.checkpoint_block_size, len(order))
+                array_out[istart:iend] = array[order[istart:iend]]
+        
+        filenames = [ array.filename for array in scratch ]
+        del scratch[:]
+        for filename in filenames:
+            os.unlink(filename)
+        
+        return out
+        
+    def _coarse_grid_indices(self):
+        stride = 2**self.refine_levels
+        axes = []
+        for param, gvalues in self.param_values:
+            n = len(gvalues)
+            axes.append(num.unique(num.concatenate((num.arange(0, n, stride), [max(n-1, 0)])))[:n])
+            
+        indices = num.indices([ len(axis) for axis in axes ]).reshape(len(axes), -1)
+        grid_indices = num.zeros((indices.shape[1], len(axes)), dtype=num.int)
+        for iparam, axis in enumerate(axes):
+            grid_indices[:,iparam] = axis[indices[iparam]]
+            
+        return grid_indices
+    
+    def _grid_sources(self, grid_indices, constrain=True):
+        '''Get sources at grid nodes, without those violating the constraints.
+        
+        Returns the sources and their grid indices.'''
+        
+        values = num.zeros(grid_indices.shape, dtype=num.float)
+        for iparam, (param, gvalues) in enumerate(self.param_values):
+            values[:,iparam] = gvalues[grid_indices[:,iparam]]
+            
+        sources = source_model.SourceGrid(self.base_source, self.sourceparams, values)
+        if constrain and self.source_constraints is not None:
+            ok = num.nonzero(sources.mask(self.source_constraints))[0]
+            return sources.take(ok), grid_indices[ok]
+        
+        return sources, grid_indices
+    
+    def _is_adaptive(self):
+        return self.grid_indices is not None
+    
+    def _compute_adaptive(self, seis, checkpoint, progress_title, receiver_mask, misfit_config, 
+                                storage=None, storage_dtype=num.float):
+        shape = num.array([ len(gvalues) for (param, gvalues) in self.param_values ], dtype=num.int)
+        nparams = shape.size
+        
+        # to number the nodes of the full grid
+        strides = num.ones(nparams, dtype=num.int)
+        for iparam in xrange(nparams-2, -1, -1):
+            strides[iparam] = strides[iparam+1]*shape[iparam+1]
+        
+        # neighbourhood of a node, in units of the current spacing
+        neighbours = num.indices((3,)*nparams).reshape(nparams, -1).T - 1
+        
+        sources, grid_indices = self._grid_sources(self._coarse_grid_indices())
+        level_sources = sources
+        
+        # each level adds at most the neighbourhoods of refine_nbest nodes
+        nmax = min(len(sources) + self.refine_levels*self.refine_nbest*len(neighbours), num.prod(shape))
+        scratch = self._allocate_scratch(seis, nmax, storage, storage_dtype)
+        
+        ndone = 0
+        failings = []
+        for level in xrange(self.refine_levels, -1, -1):
+            if level != self.refine_levels:
+                misfits_by_s = self._global_misfits(scratch[0][:ndone], scratch[1][:ndone], failings, 
+                                                    receiver_mask, misfit_config)
+                
+                ok = num.nonzero(num.isfinite(misfits_by_s))[0]
+                best = ok[num.argsort(misfits_by_s[ok])[:self.refine_nbest]]
+                
+                candidates = (grid_indices[best][:,num.newaxis,:] + 
+                              neighbours[num.newaxis,:,:]*2**level).reshape(-1, nparams)
+                candidates = num.clip(candidates, 0, shape-1)
+                
+                known = set(num.dot(grid_indices, strides))
+                new = []
+                for icandidate, node in enumerate(num.dot(candidates, strides)):
+                    if node not in known:
+                        known.add(node)
+                        new.append(icandidate)
+                
+                if not new:
+                    continue
+                
+                level_sources, level_indices = self._grid_sources(candidates[new])
+                if len(level_sources) == 0:
+                    continue
+                
+                grid_indices = num.concatenate((grid_indices, level_indices))
+                
+            level_checkpoint = None
+            if checkpoint is not None:
+                level_checkpoint = '%s.%i' % (checkpoint, level)
+                
+            nlevel = len(level_sources)
+            out = [ array[ndone:ndone+nlevel] for array in scratch ]
+            level_failings = self._compute_sources(seis, level_sources, level_checkpoint, 
+                                                   '%s (level %i)' % (progress_title, level), 
+                                                   misfit_config, out=out)[2]
+            failings.extend([ ndone+i for i in level_failings ])
+            ndone += nlevel
+            
+        # same order as in a full grid
+        order = num.argsort(num.dot(grid_indices, strides))
+        self.grid_indices = grid_indices[order]
+        self.sources = self._grid_sources(self.grid_indices, constrain=False)[0]
+        logging.info('Adaptive grid search evaluated %i of %i grid nodes' % (len(self.sources), num.prod(shape)))
+        
+        return self._finish_scratch(scratch, order, storage, storage_dtype)
+    
+    def _compute_blocks(self, seis, sources, checkpoint, progress_title, misfit_config, out=None):
+        '''Compute misfits in blocks of checkpoint_block_size sources.
+        
+        Results are written to the arrays given in out, if any, and appended
+        to the checkpoint file, if given. When pruning, the bound found in a
+        block is carried over to the next ones.'''
+        
+        nsources = len(sources)
+        nreceivers = len(seis.receivers)
+        ncomponents = max([ len(r.components) for r in seis.receivers ])
+        if out is None:
+            misfits_by_src = num.zeros( (nsources, nreceivers, ncomponents), dtype=num.float)
+            norms_by_src = num.zeros( (nsources, nreceivers, ncomponents), dtype=num.float)
+        else:
+            misfits_by_src, norms_by_src = out
+            
+        failings = []
+        
+        if misfit_config.get('prune_margin') is not None:
+            misfit_config = dict(misfit_config, prune_bound=seismosizer.PruneBound())
+        
+        ndone, f = 0, None
+        if checkpoint is not None:
+            # identifies the grid and the receiver setup the checkpoint belongs to
+            header = seismosizer.fingerprint(str(sources.base_source), sources.params, sources.values,
+                                             [ r.enabled for r in seis.receivers ], 
+                                             nreceivers, ncomponents)
+            
+            ndone, end = self._load_checkpoint(checkpoint, header, misfits_by_src, norms_by_src, failings)
+            if end is None:
+                f = open(checkpoint, 'wb')
+                pickle.dump(header, f, pickle.HIGHEST_PROTOCOL)
+            else:
+                # drop a block which has been written incompletely
+                f = open(checkpoint, 'r+b')
+                f.truncate(end)
+                f.seek(end)
+                if ndone:
+                    logging.info('Resuming grid search from checkpoint, %i of %i sources done' % (ndone, nsources))
+            
+            f.flush()
+        
+        if config.show_progress and nsources != 0:
+            widgets = [progress_title, ' ',
+                    progressbar.Bar(marker='-',left='[',right=']'), ' ',
+                    progressbar.Percentage(), ' ',]
+            
+            pbar = progressbar.ProgressBar(widgets=widgets, maxval=nsources).start()
+            pbar.update(ndone)
+        else:
+            pbar = None
+            
+        for istart in xrange(ndone, nsources, self.checkpoint_block_size):
+            iend = min(istart+self.checkpoint_block_size, nsources)
+            misfits, norms, block_failings = seis.make_misfits_for_sources(sources[istart:iend], **misfit_config)
+            block_failings = [ istart+i for i in block_failings ]
+            
+            misfits_by_src[istart:iend] = misfits
+            norms_by_src[istart:iend] = norms
+            failings.extend(block_failings)
+            
+            if f is not None:
+                pickle.dump((istart, iend, misfits, norms, block_failings), f, pickle.HIGHEST_PROTOCOL)
+                f.flush()
+                os.fsync(f.fileno())
+            
+            if pbar: pbar.update(iend)
+            
+        if pbar: pbar.finish()
+        if f is not None:
+            f.close()
+        
+        return misfits_by_src, norms_by_src, failings
+    
+    def _load_checkpoint(self, filename, header, misfits_by_src, norms_by_src, failings):
+        '''Fill in results from checkpoint file.
+        
+        Returns the number of sources done and the file position after the 
+        last valid block, which is None, if the file is unusable.'''
+        
+        if not os.path.exists(filename):
+            return 0, None
+        
+        f = open(filename, 'rb')
+        try:
+            try:
+                if pickle.load(f) != header:
+                    logging.warn('Checkpoint %s does not match grid, starting over' % filename)
+                    return 0, None
+            except Exception:
+                return 0, None
+            
+            ndone, end = 0, f.tell()
+            while True:
+                try:
+                    istart, iend, misfits, norms, block_failings = pickle.load(f)
+                except Exception:
+                    break # end of file or truncated block
+                
+                if istart != ndone or misfits.shape != misfits_by_src[istart:iend].shape:
+                    break
+                
+                misfits_by_src[istart:iend] = misfits
+                norms_by_src[istart:iend] = norms
+                failings.extend(block_failings)
+                ndone, end = iend, f.tell()
+            
+            return ndone, end
+        
+        finally:
+            f.close()
+            
     def postprocess(self, **outer_misfit_config):
         '''Combine trace misfits to global misfits, find best source, make statistics.'''
         
@@ -214,17 +661,35 @@ class MisfitGrid:
     def get_mean_misfits_by_r(self):
         '''Get mean raw misfits by receiver, e.g. to auto-create weights.''' 
         mean_misfits_by_r = num.zeros( self.nreceivers, dtype=num.float )
+        computed = self._computed()
         for irec in range(self.nreceivers):
             rec = self.receivers[irec]
             ncomps = len(rec.components)
             if ncomps != 0:
-                x = num.sum(self.misfits_by_src[:,irec,:ncomps]) /( ncomps*len(self.sources))
+                x = num.sum(self.misfits_by_src[computed,irec,:ncomps]) /( ncomps*len(computed))
             else:
                 x = -1.0
             
             mean_misfits_by_r[irec] = x
         return mean_misfits_by_r
         
+    def _computed(self):
+        '''Indices of the sources which have not been pruned.'''
+        
+        nsources = self.misfits_by_src.shape[0]
+        return num.nonzero(num.logical_not(
+            num.isnan(self.misfits_by_src.reshape((nsources, -1))).any(1)))[0]
+        
+    def get_misfits_by_s_for_weights(self, receiver_weights, **outer_misfit_config):
+        '''Get global misfits of all sources for a stack of receiver weightings.
+        
+        Returns an array of shape (nweightings, nsources), see
+        seismosizer.make_global_misfits_for_weights().'''
+        
+        return seismosizer.make_global_misfits_for_weights(
+            self.misfits_by_src, self.norms_by_src, receiver_weights, 
+            receiver_mask=self.receiver_mask, **outer_misfit_config)
+        
     def get_median_of_misfits_by_r(self):
         '''Get the median of the misfits per station of best source.'''
         
@@ -262,7 +727,7 @@ class MisfitGrid:
 
         else:
             # misfit variability by receiver
-            misfits_varia_by_r = num.std(misfits_by_sr,0)
+            misfits_varia_by_r = num.std(misfits_by_sr[self._computed()],0)
             return self.sources[ibest], misfits_by_s, misfits_by_sr[ibest,:], misfits_varia_by_r
         
     def _ref_misfits(self, **outer_misfit_config):
@@ -271,8 +736,15 @@ class MisfitGrid:
             receiver_mask=self.receiver_mask, **outer_misfit_config)
         return misfits_by_s[0], misfits_by_sr[0,:]
         
-    def _bootstrap(self, bootstrap_iterations=1000, **outer_misfit_config):
-        bootstrap_sources = []
+    def _bootstrap(self, bootstrap_iterations=1000, receiver_weights=1., outer_norm='l2norm', 
+                         anarchy=False, **kwargs):
+        '''Find best sources for bootstrap resamplings of the receivers.
+        
+        The resamplings are evaluated in chunks, each by a matrix product of
+        the misfit terms with the resampling weights, see 
+        seismosizer.misfits_from_terms().'''
+        
+        ibests = []
         if config.show_progress:
             widgets = ['Bootstrapping', ' ',
                     progressbar.Bar(marker='-',left='[',right=']'), ' ',
@@ -280,20 +752,35 @@ class MisfitGrid:
             
             pbar = progressbar.ProgressBar(widgets=widgets, maxval=bootstrap_iterations).start()
             
-        for i in xrange(bootstrap_iterations):
-            bootstrap_sources.append( self._best_source(bootstrap=True, **outer_misfit_config)[0] )
-            if config.show_progress: pbar.update(i+1)
+        mterms, nterms = seismosizer.make_misfit_terms(self.misfits_by_src, self.norms_by_src,
+                                                       outer_norm=outer_norm, anarchy=anarchy)
+        
+        nsources, nreceivers = mterms.shape
+        rweights = num.ones(nreceivers, dtype=num.float) * receiver_weights
+        mask = num.logical_and(rweights != 0., self.receiver_mask)
+        if outer_norm == 'l2norm':
+            rweights = rweights**2
+            
+        chunk = max(1, self.bootstrap_chunk_size // max(1, nsources))
+        for istart in xrange(0, bootstrap_iterations, chunk):
+            n = min(chunk, bootstrap_iterations-istart)
+            tweights = seismosizer.bootstrap_weights(n, nreceivers, mask) * rweights
+            misfits = seismosizer.misfits_from_terms(mterms, nterms, tweights, outer_norm=outer_norm)
+            
+            # first source, if all misfits are undefined
+            ibests.extend(num.argmin(num.where(num.isnan(misfits), num.inf, misfits), 0))
+            if config.show_progress: pbar.update(istart+n)
             
         if config.show_progress: pbar.finish()
         
-        return bootstrap_sources
+        return source_model.take_sources(self.sources, ibests)
         
     def _stats(self, param_values, best_source, bootstrap_sources):
         
         results = {}
         for param, gvalues in param_values:
 
-            distribution = num.array([ source[param] for source in bootstrap_sources ], dtype=num.float)
+            distribution = source_model.get_param_values(bootstrap_sources, param)
             result = MisfitGridStats( param, best_source[param], distribution, tested_values=gvalues )
             results[param] = result
             
@@ -301,6 +788,20 @@ class MisfitGrid:
         
 
         
+    def _binned_values(self, sources, param):
+        '''Get values of a parameter, snapped to the grid values if the sources are sampled.'''
+        
+        values = source_model.get_param_values(sources, param)
+        if getattr(self, 'nsamples', None) is None:
+            return values
+        
+        gvalues = num.sort(self.param_values[self.sourceparams.index(param)][1])
+        if gvalues.size < 2:
+            return values
+        
+        ivalues = num.searchsorted(0.5*(gvalues[1:]+gvalues[:-1]), values)
+        return gvalues[ivalues]
+        
     def plot(self, dirname, nsets=1, source_model_infos=None, conf_overrides=None):
         
         best_source = self.best_source
@@ -315,12 +816,9 @@ class MisfitGrid:
             #
             # 1D misfit cross section
             #
-            xy = []
-            for s,m in zip(self.sources, self.misfits_by_s):
-                if not num.isnan(m):
-                    xy.append((s[param], m))
-            
-            xdata, ydata = num.array(xy,dtype=num.float).transpose()
+            ok = num.logical_not(num.isnan(self.misfits_by_s))
+            xdata = source_model.get_param_values(self.sources, param)[ok]
+            ydata = num.asarray(self.misfits_by_s, dtype=num.float)[ok]
             
             conf = dict( xlabel = param.title(),
                          xunit = self.base_source.sourceinfo(param).unit )
@@ -423,16 +921,15 @@ class MisfitGrid:
                 #
                 vmisfits = {}
                 maxmisfit = num.nanmax(self.misfits_by_s)
-                for (source, misfit) in zip(self.sources, self.misfits_by_s):
+                for (vx, vy, misfit) in zip(self._binned_values(self.sources, xparam),
+                                            self._binned_values(self.sources, yparam),
+                                            self.misfits_by_s):
                     if num.isnan(misfit): continue
-                    vx = source[xparam]
-                    vy = source[yparam]
                     vmisfits[(vx,vy)] = min(vmisfits.get((vx,vy), maxmisfit), misfit)
                     
                 vcounts = {}
-                for source in bootstrap_sources:
-                    vx = source[xparam]
-                    vy = source[yparam]
+                for (vx, vy) in zip(self._binned_values(bootstrap_sources, xparam),
+                                    self._binned_values(bootstrap_sources, yparam)):
                     vcounts[(vx,vy)] = vcounts.get((vx,vy), 0) + 1
                 
                 lx, ly, lz = [], [], []
@@ -538,3 +1035,166 @@ class MisfitGrid:
         
         return plot_files
     
+
+
+class SurrogateGrid(MisfitGrid):
+    '''Surrogate model guided search, with the statistics of MisfitGrid.
+    
+    compute() starts with nsamples sources drawn between the smallest and 
+    largest grid value of each parameter. In each of niterations 
+    iterations, a radial basis function is fitted to the global misfits of
+    the sources evaluated so far, and batch_size new sources are chosen 
+    among random candidates, by a weighted score of the predicted misfit 
+    and the distance to the known sources (after Regis and Shoemaker, 
+    2007). Afterwards, the evaluated sources are handled like the sampled 
+    sources of a MisfitGrid.'''
+    
+    # weights of the predicted misfit in the score, cycled through in a batch
+    score_weights = (0.3, 0.5, 0.8, 0.95)
+    
+    # number of random candidates per new source
+    candidates_per_source = 100
+    
+    def __init__( self, base_source,
+                        param_ranges=None,
+                        param_values=None,
+                        source_constraints=None,
+                        ref_source=None,
+                        prune_margin=None,
+                        nsamples=64,
+                        sampling='sobol',
+                        sampling_seed=0,
+                        niterations=10,
+                        batch_size=16,
+                        rbf_function='cubic',
+                        surrogate_max_points=1000):
+        
+        MisfitGrid.__init__(self, base_source, param_ranges, param_values, 
+                            source_constraints=source_constraints,
+                            ref_source=ref_source,
+                            prune_margin=prune_margin,
+                            nsamples=nsamples,
+                            sampling=sampling,
+                            sampling_seed=sampling_seed)
+        
+        self.sampling_seed = sampling_seed
+        self.niterations = niterations
+        self.batch_size = batch_size
+        self.rbf_function = rbf_function
+        self.surrogate_max_points = surrogate_max_points
+        
+    def _is_adaptive(self):
+        return True
+    
+    def _compute_adaptive(self, seis, checkpoint, progress_title, receiver_mask, misfit_config, 
+                                storage=None, storage_dtype=num.float):
+        rstate = num.random.RandomState(self.sampling_seed)
+        vmins, vscales = self._unit_scale()
+        
+        sources = self.sources
+        values = sources.values
+        nmax = len(sources) + self.niterations*self.batch_size
+        scratch = self._allocate_scratch(seis, nmax, storage, storage_dtype)
+        
+        ndone = 0
+        failings = []
+        for iteration in xrange(self.niterations+1):
+            if iteration != 0:
+                misfits_by_s = self._global_misfits(scratch[0][:ndone], scratch[1][:ndone], failings, 
+                                                    receiver_mask, misfit_config)
+                
+                points = self._acquire((values-vmins)/num.where(vscales > 0., vscales, 1.), 
+                                       misfits_by_s, rstate)
+                if len(points) == 0:
+                    break
+                
+                sources = source_model.SourceGrid(self.base_source, self.sourceparams, 
+                                                  vmins + points*vscales)
+                values = num.concatenate((values, sources.values))
+                
+            iteration_checkpoint = None
+            if checkpoint is not None:
+                iteration_checkpoint = '%s.%i' % (checkpoint, iteration)
+                
+            out = [ array[ndone:ndone+len(sources)] for array in scratch ]
+            iteration_failings = self._compute_sources(seis, sources, iteration_checkpoint, 
+                                                   '%s (iteration %i)' % (progress_title, iteration), 
+                                                   misfit_config, out=out)[2]
+            failings.extend([ ndone+i for i in iteration_failings ])
+            ndone += len(sources)
+        
+        self.sources = source_model.SourceGrid(self.base_source, self.sourceparams, values)
+        logging.info('Surrogate search evaluated %i sources' % len(self.sources))
+        
+        return self._finish_scratch(scratch, num.arange(ndone), storage, storage_dtype)
+    
+    def _unit_scale(self):
+        '''Get offsets and scales mapping the parameter ranges to [0,1].'''
+        
+        vmins = num.array([ num.min(gvalues) for (param, gvalues) in self.param_values ], dtype=num.float)
+        vmaxs = num.array([ num.max(gvalues) for (param, gvalues) in self.param_values ], dtype=num.float)
+        return vmins, num.where(vmaxs > vmins, vmaxs-vmins, 0.)
+    
+    def _acquire(self, points, misfits_by_s, rstate):
+        '''Choose up to batch_size new points, given the evaluated points.
+        
+        All points are in unit coordinates, see _unit_scale(). Points with
+        undefined misfits, e.g. failing sources, are only used to keep
+        distance from.'''
+        
+        vmins, vscales = self._unit_scale()
+        npoints, nparams = points.shape
+        ok = num.nonzero(num.isfinite(misfits_by_s))[0]
+        ok = ok[num.argsort(misfits_by_s[ok])][:self.surrogate_max_points]
+        
+        # candidates, half of them uniform, half of them around the best point
+        ncandidates = self.candidates_per_source*self.batch_size
+        candidates = rstate.uniform(size=(ncandidates, nparams))
+        if len(ok) != 0:
+            nlocal = ncandidates/2
+            candidates[:nlocal] = num.clip(points[ok[0]] + rstate.normal(scale=0.1, size=(nlocal, nparams)), 
+                                           0., 1.)
+        candidates[:,vscales == 0.] = 0.
+        
+        if self.source_constraints is not None:
+            sources = source_model.SourceGrid(self.base_source, self.sourceparams, 
+                                              vmins + candidates*vscales)
+            candidates = candidates[sources.mask(self.source_constraints)]
+        
+        distances2 = num.sum(candidates**2, axis=1)[:,num.newaxis] + num.sum(points**2, axis=1) \
+                        - 2.*num.dot(candidates, points.T)
+        distances = num.sqrt(num.maximum(num.min(distances2, axis=1), 0.))
+        
+        if len(ok) < 2:
+            # nothing to fit yet
+            return candidates[distances > 1e-6][:self.batch_size]
+        
+        rbf = scipy.interpolate.Rbf(*(list(points[ok].T) + [misfits_by_s[ok]]), 
+                                    function=self.rbf_function)
+        predicted = rbf(*candidates.T)
+        
+        # greedy choice, points already chosen count as known
+        chosen = []
+        for ichoice in xrange(self.batch_size):
+            available = distances > 1e-6
+            if not num.any(available):
+                break
+            
+            w = self.score_weights[ichoice % len(self.score_weights)]
+            score = w*normalized(predicted, available) + (1.-w)*(1.-normalized(distances, available))
+            score[num.logical_not(available)] = num.inf
+            ibest = num.argmin(score)
+            chosen.append(ibest)
+            distances = num.minimum(distances, 
+                                    num.sqrt(num.sum((candidates - candidates[ibest])**2, axis=1)))
+            
+        return candidates[chosen]
+    
+def normalized(values, mask):
+    '''Scale values to [0,1], based on the range of values[mask].'''
+    
+    mi, ma = num.min(values[mask]), num.max(values[mask])
+    if ma == mi:
+        return num.zeros(values.shape, dtype=num.float)
+    
+    return (values-mi)/(ma-mi)
@@ -10,10 +10,14 @@ from pyrocko import moment_tensor
 import orthodrome
 import gridsearch
 import filtering
+import phase
 from util import gform
 
 import shutil
 import os
+import glob
+import threading
+import Queue
 import sys
 import re
 import math
@@ -115,6 +119,25 @@ def grid_defi( param, oldval, descr ):
 
 
 
+def find_phases(x):
+    '''Get the phases used in x, e.g. by the timings of a taper.'''
+    
+    if isinstance(x, phase.Phase):
+        return [ x ]
+    
+    if isinstance(x, dict):
+        x = x.values()
+    elif hasattr(x, '__dict__'):
+        x = vars(x).values()
+    elif not isinstance(x, (list, tuple)):
+        return []
+    
+    phases = []
+    for y in x:
+        phases.extend(find_phases(y))
+        
+    return phases
+
 def standard_setup( datadir,
                     gfdb_path,
                     components,
@@ -237,9 +260,10 @@ class Step:
         self.stepdir = pjoin(self.baseworkdir, self.stepname)
         self.seismosizer = None
         self.required = set(standard_setup.required)
-        self.optional = set(standard_setup.optional)
+        self.optional = set(standard_setup.optional) | set(('misfit_store', 'misfit_store_max_entries', 'misfit_store_prune', 'checkpoint'))
         self.dump_processing = dump_processing
         self.failure_check = failure_check
+        self.resume = False
         
     def make_rundir_path(self, run_id):
         return pjoin(self.stepdir, str(run_id))
@@ -267,7 +291,55 @@ class Step:
         else:
             return self.out_config.get_config()
     
-    def pre_work(self, start_seismosizer=True):
+    def make_checkpoint_path(self):
+        return pjoin(self.make_rundir_path('incomplete'), 'checkpoint.pickle')
+    
+    def get_checkpoint_path(self):
+        '''Get checkpoint filename for the grid search, if config parameter
+           checkpoint is set, else None.'''
+        
+        if self.in_config.get_config().get('checkpoint', False):
+            return self.make_checkpoint_path()
+        
+        return None
+
+    def storage_config(self):
+        '''Get storage arguments for MisfitGrid.compute() from the config.
+
+           With misfit_storage set, the misfits are kept in memory-mapped .npy
+           files in the rundir, as misfit_dtype (e.g. 'float32').'''
+
+        conf = self.in_config.get_config()
+        storage = {}
+        if conf.get('misfit_storage', False):
+            storage['storage'] = pjoin(self.make_rundir_path('incomplete'), self.stepname)
+        if 'misfit_dtype' in conf:
+            storage['storage_dtype'] = num.dtype(conf['misfit_dtype'])
+
+        return storage
+
+    def can_resume(self):
+        '''Check if the incomplete run of the step was started with the current
+           config.'''
+        
+        fn = pjoin(self.make_rundir_path('incomplete'), 'config-in.pickle')
+        if not os.path.exists(fn):
+            return False
+        
+        old = config.Config(fn).get_config()
+        new = self.in_config.get_config()
+        return seismosizer.fingerprint(old) == seismosizer.fingerprint(new)
+        
+    def pre_work(self, start_seismosizer=True, resume=None):
+        '''Prepare the incomplete rundir and start the seismosizers.
+        
+           If resume is True, the rundir of an incomplete run with the same
+           config is kept (see get_checkpoint_path()). It defaults to the 
+           resume attribute of the step.'''
+        
+        if resume is None:
+            resume = self.resume
+        
         assert(self.in_config is not None)
         
         have = set(self.in_config.get_config().keys())
@@ -280,9 +352,14 @@ class Step:
         
         logging.info('Starting work on step %s' % self.stepname)
         rundir = self.make_rundir_path('incomplete')
-        if os.path.exists( rundir ): 
-            shutil.rmtree( rundir )
-        os.makedirs( rundir )
+        if resume and self.can_resume():
+            logging.info('Resuming incomplete run of step %s' % self.stepname)
+        else:
+            if resume:
+                logging.warn('Cannot resume step %s, config has changed' % self.stepname)
+            if os.path.exists( rundir ): 
+                shutil.rmtree( rundir )
+            os.makedirs( rundir )
         self.in_config.dump( pjoin(rundir,'config-in.pickle') )
         self.out_config = config.Config()
         
@@ -326,15 +403,66 @@ class Step:
         if 'floating_shiftrange' in conf and conf['floating_shiftrange'] is not None:
             seis.set_floating_shiftrange(0, *conf['floating_shiftrange'] )
         
+        self.open_misfit_store()
+        
+    def open_misfit_store(self):
+        '''Let the seismosizer keep misfits in the step's misfit store, if
+           config parameter misfit_store is set.
+           
+           The store is shared by all runs of the step. It is keyed by the 
+           parameters and data files influencing the misfits, so that e.g. a
+           rerun with different outer misfit parameters needs no forward 
+           modelling.'''
+        
+        conf = self.in_config.get_config()
+        if not conf.get('misfit_store', False):
+            return
+        
+        keys = (standard_setup.required | standard_setup.optional | Step.inner_misfit_method_params) \
+                - set(('hosts', 'balance_method', 'verbose'))
+        
+        params = dict([ (k, conf[k]) for k in keys if k in conf ])
+        datadir = conf['datadir']
+        filenames = [ pjoin(datadir, fn) for fn in sorted(os.listdir(datadir)) ]
+        
+        # Greens function database and phase tables may be rebuilt in place
+        gfdb_path = conf['gfdb_path']
+        filenames.extend(sorted(glob.glob(gfdb_path+'.index') + glob.glob(gfdb_path+'.*.chunk')))
+        filenames.extend(sorted(set([ phase.phase_filename(p.name, p.filename) 
+                                      for p in find_phases(params.values()) ])))
+        
+        files = []
+        for fn in filenames:
+            st = os.stat(fn)
+            files.append((fn, st.st_size, int(st.st_mtime)))
+        
+        fingerprint = seismosizer.fingerprint(params, files)
+        filename = pjoin(self.stepdir, 'misfits.sqlite')
+        logging.info('Using misfit store %s' % filename)
+        store = seismosizer.MisfitStore(filename, fingerprint, 
+                                        max_entries=conf.get('misfit_store_max_entries', None))
+        if conf.get('misfit_store_prune', False):
+            logging.info('Pruned %i entries of other configurations from misfit store' % store.prune())
+            
+        self.seismosizer.set_misfit_store(store)
+        
     def post_work(self, stop_seismosizer=True):
         
         self.make_alternative_stats()
         self.make_locations()
 
         if stop_seismosizer:
+            logging.info('Redundant seismosizer commands skipped: %i' % self.seismosizer.nsuppressed)
+            logging.info('Misfit cache hits: %(hits)i, misses: %(misses)i' % self.seismosizer.misfit_cache.stats())
+            if self.seismosizer.misfit_store is not None:
+                logging.info('Misfit store hits: %(hits)i, misses: %(misses)i, entries: %(entries)i' % self.seismosizer.misfit_store.stats())
+                self.seismosizer.set_misfit_store(None)
+                
             self.seismosizer.close()
         
         rundir = self.make_rundir_path('incomplete')
+        for fn in glob.glob(self.make_checkpoint_path()+'*'):
+            os.remove(fn)
         self.out_config.dump(pjoin(rundir, 'config-out.pickle'))
         if os.path.exists( self.make_rundir_path('current') ):
             shutil.move(self.make_rundir_path('current'), self.next_available_rundir())
@@ -444,6 +572,8 @@ class Step:
     def dump(self, object, ident, run_id='incomplete'):
         rundir = self.make_rundir_path(run_id)
         filename = pjoin(rundir, '%s.pickle' % ident)
+        if hasattr(object, 'copy_storage'):
+            object.copy_storage(rundir)
         f = open(filename, 'w')
         pickle.dump(object, f)
         f.close()
@@ -461,6 +591,8 @@ class Step:
         f = open(filename, 'r')
         object = pickle.load(f)
         f.close()
+        if hasattr(object, 'attach_storage'):
+            object.attach_storage(rundir)
         return object
 
     def plot(self, run_id='current'):
@@ -864,7 +996,11 @@ class ExtConfigurator(Step):
         self.post_work(False)
 
 class ParamTuner(Step):
-     
+    
+    # the grid search and the config keys passed to it
+    finder_class = gridsearch.MisfitGrid
+    finder_params = ('refine_levels', 'refine_nbest', 'prune_margin', 'nsamples', 'sampling', 'sampling_seed')
+    
     def __init__(self, workdir, sourcetype='eikonal', params=['time'], name=None, 
             xblacklist_level=None, dump_processing='filtered', ref_source_from=None, failure_check=None):
         if name is None: name = '-'.join(params)+'-tuner'
@@ -878,7 +1014,9 @@ class ParamTuner(Step):
                         | set([param+'_range' for param in self.params]) \
                         | set(self.params)
                         
-        self.optional |= set([d2u(p) for p in source_model.param_names(self.sourcetype)])
+        self.optional |= set([d2u(p) for p in source_model.param_names(self.sourcetype)]) \
+                        | set(self.finder_params) \
+                        | set(('misfit_storage', 'misfit_dtype'))
         
     def work(self, search=True, forward=True, run_id='current'):
         self.pre_work(search or forward)
@@ -918,9 +1056,8 @@ class ParamTuner(Step):
             else:
                 ref_source = None
             
-            self.setup_inner_misfit_method()
-            finder = gridsearch.MisfitGrid( base_source, param_values=grid_def, ref_source=ref_source)
-            finder.compute(seis)
+            finder = self.make_finder( base_source, grid_def, ref_source, conf )
+            finder.compute(seis, checkpoint=self.get_checkpoint_path(), **dict(self.storage_config(), **mm_conf))
         else:
             finder = self.load(self.stepname, run_id=run_id)
             
@@ -968,6 +1105,13 @@ class ParamTuner(Step):
             
         self.post_work(search or forward)
         
+    def make_finder(self, base_source, grid_def, ref_source, conf):
+        finder_conf = {}
+        for k in self.finder_params:
+            if k in conf: finder_conf[k] = conf[k]
+            
+        return self.finder_class( base_source, param_values=grid_def, ref_source=ref_source, **finder_conf)
+        
     def _plot( self, run_id='current' ):
         plot_files = []
         
@@ -985,6 +1129,20 @@ class ParamTuner(Step):
         
         return plot_files
     
+class SurrogateTuner(ParamTuner):
+    '''Like ParamTuner, but guided by a surrogate model of the misfit.
+    
+    The grid given by the *_range settings only defines the parameter 
+    ranges and the bins of the statistics. See gridsearch.SurrogateGrid.'''
+    
+    finder_class = gridsearch.SurrogateGrid
+    finder_params = ('prune_margin', 'nsamples', 'sampling', 'sampling_seed', 'niterations', 
+                     'batch_size', 'rbf_function', 'surrogate_max_points')
+    
+    def __init__(self, workdir, sourcetype='eikonal', params=['time'], name=None, **kwargs):
+        if name is None: name = '-'.join(params)+'-surrogate'
+        ParamTuner.__init__(self, workdir, sourcetype, params, name, **kwargs)
+    
 class EnduringPointSource(Step):
     
     def __init__(self, workdir, name='extension', failure_check=None):
@@ -996,7 +1154,8 @@ class EnduringPointSource(Step):
                         | set([param+'_range' for param in self.params]) \
                         | set(self.params)
                         
-        self.optional |= set([d2u(p) for p in source_model.param_names('eikonal')])
+        self.optional |= set([d2u(p) for p in source_model.param_names('eikonal')]) \
+                        | set(('misfit_storage', 'misfit_dtype'))
     
     def work(self, search=True, forward=True, run_id='current'):
         self.pre_work(search or forward)
@@ -1020,9 +1179,8 @@ class EnduringPointSource(Step):
             
         if search or forward: self.setup_inner_misfit_method()
         if search:
-            self.setup_inner_misfit_method()
             finder = gridsearch.MisfitGrid( base_source, param_values=grid_def )
-            finder.compute(seis)
+            finder.compute(seis, checkpoint=self.get_checkpoint_path(), **self.storage_config())
         else:
             finder = self.load(self.stepname, run_id=run_id)
             
@@ -1147,7 +1305,8 @@ class Greeper(Step):
                         | set([param+'_range' for param in self.params]) \
                         | set(self.params)
                         
-        self.optional |= set([d2u(p) for p in source_model.param_names(sourcetype)])
+        self.optional |= set([d2u(p) for p in source_model.param_names(sourcetype)]) \
+                        | set(('nparallel_searches',))
         
     def work(self, search=True, forward=True, run_id='current'):
         self.pre_work(search or forward)
@@ -1213,23 +1372,80 @@ class Greeper(Step):
             return x
         
         
-        def minfunc(x):
-            self.nminfunccalls += 1
-            source = x_to_source(x)
+        def minfunc(x, batcher, ncalls, epsilon):
+            '''Get misfit at x and its gradient by forward differences.
+            
+            The source at x and the sources displaced by epsilon along each
+            axis are evaluated as one batch.'''
+            
+            sources = [ x_to_source(x) ]
+            for i in xrange(len(x)):
+                xi = num.array(x, dtype=num.float)
+                xi[i] += epsilon
+                sources.append(x_to_source(xi))
+                
+            ncalls[0] += len(sources)
+            logging.debug('Evaluating source: %s', sources[0].pretty_str(dparams) )
+            misfits = batcher.misfits(sources)
+            for source, misfit in zip(sources, misfits):
+                if num.isnan(misfit):
+                    logging.warn('Gradient search aborted at invalid source:' )
+                    for str_param in source.pretty_str(dparams).splitlines():
+                        logging.warn( str_param )
+                    raise seismosizer.NoValidSources()
+                
+            logging.debug('Misfit: %g' % misfits[0])
+            return misfits[0], (misfits[1:] - misfits[0])/epsilon
+        
+        def gradient_search(starter_source, batcher):
+            '''Run gradient search from starter_source.
+            
+            Returns the starting source with its misfit, the minimum found
+            with its misfit, and the number of misfit evaluations. The
+            starting source is None if it is invalid and the minimum is None
+            if the search failed.'''
+            
+            ncalls = [0]
+            
+            # look if starting source is valid
+            current_base = copy.deepcopy(starter_source)
+            base_misfit = batcher.misfits([current_base])[0]
+            if num.isnan(base_misfit):
+                return None, None, None, None, ncalls[0]
+            
+            current = current_base
+            try:
+                for epsilon, factr in (0.2, 1e10), (0.05, 1e7):
+                    # (re)start gradient search at current minimum
+                    x0 = source_to_x(current)
+                    x, misfit, d = fmin_l_bfgs_b(minfunc, x0, args=(batcher, ncalls, epsilon), 
+                                                 bounds=bounds, factr=factr)
+                    current = x_to_source(x)
+                    if d['warnflag'] != 0:
+                        return current_base, base_misfit, None, None, ncalls[0]
+                    
+            except seismosizer.NoValidSources:
+                return current_base, base_misfit, None, None, ncalls[0]
+            
+            return current_base, base_misfit, current, misfit, ncalls[0]
+        
+        def search_worker(todo, results, batcher):
             try:
-                logging.debug('Evaluating source: %s', source.pretty_str(dparams) )
-                best, misfit = seis.best_source([source], **mm_conf)
-                logging.debug('Misfit: %g' % misfit)
-            except NoValidSources:
-                logging.warn('Gradient search aborted at invalid source:' )
-                for str_param in current_base.pretty_str(dparams).splitlines():
-                    logging.warn( str_param )
-                raise
-            return misfit
+                while True:
+                    try:
+                        istarter = todo.get_nowait()
+                    except Queue.Empty:
+                        break
+                    
+                    try:
+                        results[istarter] = gradient_search(starter_sources[istarter], batcher)
+                    except Exception, e:
+                        results[istarter] = e
+                        break
+            finally:
+                batcher.finished()
             
         if search:
-            self.setup_inner_misfit_method()
-                        
             # fix depth range by trying out different depths
             for iparam, (param, vals) in enumerate(grid_def):
                 if param == 'depth':
@@ -1244,46 +1460,48 @@ class Greeper(Step):
                     bounds[iparam] = ((miok+gridsearch.step_at(ok,miok)*0.3)/norms[iparam],
                                       (maok-gridsearch.step_at(ok,maok)*0.3)/norms[iparam])
             
-            # grid search over gradient searches
+            # grid search over gradient searches, nparallel of them run
+            # concurrently and share the seismosizer pool
+            nparallel = max(1, min(int(conf.get('nparallel_searches', len(seis))), len(starter_sources)))
+            batcher = seismosizer.MisfitBatcher(seis, nparallel, **mm_conf)
+            todo = Queue.Queue()
+            for istarter in xrange(len(starter_sources)):
+                todo.put(istarter)
+                
+            results = [ None ] * len(starter_sources)
+            workers = [ threading.Thread(target=search_worker, args=(todo, results, batcher)) 
+                        for iworker in xrange(nparallel) ]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            
+            for result in results:
+                if isinstance(result, Exception):
+                    raise result
+                
+            logging.info('Number of batches evaluated by concurrent gradient searches: %i' % batcher.nbatches)
+            
             min_misfit = None
             very_best_source = None
             ngood = 0
             ntotal = 0
-            for starter_source in starter_sources:
+            for starter_source, result in zip(starter_sources, results):
                 ntotal += 1
-                # look if starting source is valid
-                current_base = copy.deepcopy(starter_source)
-                try:
-                    current_base, misfit = seis.best_source([current_base], **mm_conf)
-                except NoValidSources:
+                current_base, base_misfit, current, misfit, ncalls = result
+                self.nminfunccalls += ncalls
+                if current_base is None:
                     logging.warn('Skipping invalid starting source:')
-                    for str_param in current_base.pretty_str(dparams).splitlines():
+                    for str_param in starter_source.pretty_str(dparams).splitlines():
                         logging.warn( str_param )
                     continue
+                
                 if min_misfit == None:
-                    min_misfit = misfit
+                    min_misfit = base_misfit
                     very_best_source = current_base
                 
-                x0 = source_to_x(current_base)
-                try:
-                    x, misfit, d = fmin_l_bfgs_b(minfunc, x0, approx_grad=True, bounds=bounds, epsilon=0.2, factr=1e10)
-                except NoValidSources:
-                    continue
-                current = x_to_source(x)
-                if d['warnflag'] != 0: continue
-                
-                # restart gradient search at current minimum
-                
-                x0 = source_to_x(current)
-                try:
-                    x, misfit, d = fmin_l_bfgs_b(minfunc, x0, approx_grad=True, bounds=bounds, epsilon=0.05, factr=1e7)
-                except NoValidSources:
-                    continue
-                current = x_to_source(x)
-                if d['warnflag'] != 0: continue
-
+                if current is None: continue
                 
-                minkind = ''
                 if misfit < min_misfit:
                     logging.info('Found possible minimum: Misfit = %f' % misfit)
                     for str_param in current.pretty_str(dparams).splitlines():
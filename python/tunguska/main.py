@@ -32,6 +32,7 @@ def kiwi_main(steps):
     parser.add_option('--no-forward', action='store_false', dest='do_forward', default=True)
     parser.add_option('--no-plot', action='store_false', dest='do_plot', default=True)
     parser.add_option('--run-id', action='store', dest='run_id', type='string', default='current')
+    parser.add_option('--resume', action='store_true', dest='resume', default=False)
     
     (options, args) = parser.parse_args()
     
@@ -135,6 +136,7 @@ def kiwi_main(steps):
     for step in steps:
         if step.stepname in stepnames_to_do:
             if command == 'work':
+                step.resume = options.resume
                 step.work(search=options.do_search, forward=options.do_forward, run_id=options.run_id)
                 if options.do_plot:
                     step.plot(run_id=options.run_id)
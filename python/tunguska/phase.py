@@ -32,19 +32,24 @@ class PLF:
         frac = (x-xdata[i-1])/(xdata[i]-xdata[i-1])
         return ydata[i-1], ydata[i], frac
         
+def phase_filename(name, filename=None):
+    '''Get name of the file, from which Phase(name, filename) is read.'''
+    
+    if filename is None:
+        if os.path.isfile(name+'.phase'):
+            filename = name+'.phase'
+        else:
+            filename = os.path.join(util.kiwi_aux_dir(), 'phases', name)
+            
+    return filename
+
 class Phase:
     def __init__(self,name,filename=None):
     
         self.name = name
         self.filename = filename
-        if filename is None:
-            if os.path.isfile(name+'.phase'):
-                filename = name+'.phase'
-            else:
-                filename = os.path.join(util.kiwi_aux_dir(), 'phases', name)
-            
         
-        f = open(filename,'r')
+        f = open(phase_filename(name, filename),'r')
         self.ref_points = []
         dists = {}
         distances, depths, times = [], [], []
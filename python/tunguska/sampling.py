@@ -0,0 +1,150 @@
+'''Sampling of the unit hypercube, used to create sets of sources.
+
+All functions return arrays of shape (nsamples, ndim) with values in [0,1).
+'''
+
+import numpy as num
+
+methods = ('uniform', 'lhs', 'halton', 'sobol')
+
+# primitive polynomials and initial direction numbers for the Sobol sequence
+# in dimensions 2, 3, ..., after S. Joe and F. Y. Kuo (2008), given as
+# (degree, coefficients, [m_1, ..., m_degree])
+sobol_directions = [
+    (1,  0, [1]),
+    (2,  1, [1, 3]),
+    (3,  1, [1, 3, 1]),
+    (3,  2, [1, 1, 1]),
+    (4,  1, [1, 1, 3, 3]),
+    (4,  4, [1, 3, 5, 13]),
+    (5,  2, [1, 1, 5, 5, 17]),
+    (5,  4, [1, 1, 5, 5, 5]),
+    (5,  7, [1, 1, 7, 11, 19]),
+    (5, 11, [1, 1, 5, 1, 1]),
+    (5, 13, [1, 1, 1, 3, 11]),
+    (5, 14, [1, 3, 5, 5, 31]),
+    (6,  1, [1, 3, 3, 9, 7, 49]),
+    (6, 13, [1, 1, 1, 15, 21, 21]),
+    (6, 16, [1, 3, 1, 13, 27, 49]),
+    (6, 19, [1, 1, 1, 15, 7, 5]),
+    (6, 22, [1, 3, 1, 15, 13, 25]),
+    (6, 25, [1, 1, 5, 5, 19, 61]),
+    (7,  1, [1, 3, 7, 11, 23, 15, 103]),
+    (7,  4, [1, 3, 7, 13, 13, 15, 69]),
+]
+
+sobol_bits = 32
+
+def primes(n):
+    '''Get the first n prime numbers.'''
+
+    result = []
+    candidate = 2
+    while len(result) < n:
+        if all([ candidate % p != 0 for p in result if p*p <= candidate ]):
+            result.append(candidate)
+        candidate += 1
+
+    return result
+
+def uniform(nsamples, ndim, seed=None):
+    '''Pseudo-random samples.'''
+
+    return num.random.RandomState(seed).uniform(size=(nsamples, ndim))
+
+def latin_hypercube(nsamples, ndim, seed=None):
+    '''Latin hypercube samples.
+
+    Each parameter range is divided into nsamples bins of equal width, and
+    each bin holds exactly one sample, at a random position.'''
+
+    rstate = num.random.RandomState(seed)
+    samples = num.zeros((nsamples, ndim), dtype=num.float)
+    for idim in xrange(ndim):
+        samples[:,idim] = (rstate.permutation(nsamples) + rstate.uniform(size=nsamples)) / nsamples
+
+    return samples
+
+def halton(nsamples, ndim, skip=0):
+    '''Halton sequence, using the first ndim primes as bases.'''
+
+    samples = num.zeros((nsamples, ndim), dtype=num.float)
+    for idim, base in enumerate(primes(ndim)):
+        # radical inverse of the sample indices
+        indices = num.arange(skip, skip+nsamples, dtype=num.int64)
+        factor = 1.0/base
+        while num.any(indices > 0):
+            samples[:,idim] += (indices % base) * factor
+            indices //= base
+            factor /= base
+
+    return samples
+
+def sobol_direction_numbers(ndim):
+    '''Get direction numbers of the Sobol sequence as array (ndim, sobol_bits).'''
+
+    if ndim > len(sobol_directions) + 1:
+        raise Exception('Sobol sampling is available for up to %i dimensions' % (len(sobol_directions)+1))
+
+    nbits = sobol_bits
+    directions = num.zeros((ndim, nbits), dtype=num.uint64)
+    if ndim == 0:
+        return directions
+
+    directions[0] = [ 1 << (nbits-1-k) for k in xrange(nbits) ]
+    for idim in xrange(1, ndim):
+        s, a, m = sobol_directions[idim-1]
+        v = []
+        for k in xrange(nbits):
+            if k < s:
+                v.append(m[k] << (nbits-1-k))
+            else:
+                x = v[k-s] ^ (v[k-s] >> s)
+                for j in xrange(1, s):
+                    if (a >> (s-1-j)) & 1:
+                        x ^= v[k-j]
+                v.append(x)
+
+        directions[idim] = v
+
+    return directions
+
+def sobol(nsamples, ndim, skip=0):
+    '''Sobol sequence, in Gray code order.'''
+
+    if skip + nsamples > 2**sobol_bits:
+        raise Exception('Sobol sampling is limited to %i samples' % 2**sobol_bits)
+
+    directions = sobol_direction_numbers(ndim)
+    indices = num.arange(skip, skip+nsamples, dtype=num.uint64)
+    gray = indices ^ (indices >> num.uint64(1))
+
+    samples = num.zeros((nsamples, ndim), dtype=num.float)
+    for idim in xrange(ndim):
+        x = num.zeros(nsamples, dtype=num.uint64)
+        for k in xrange(sobol_bits):
+            bit = (gray >> num.uint64(k)) & num.uint64(1)
+            x ^= bit * directions[idim,k]
+
+        samples[:,idim] = x / float(2**sobol_bits)
+
+    return samples
+
+def sample(method, nsamples, ndim, seed=None):
+    '''Get nsamples points in the ndim-dimensional unit hypercube.
+
+    method: One of 'uniform', 'lhs' (latin hypercube), 'halton', or 'sobol'.
+    seed: Seed for the random methods. The quasi-random sequences are
+        deterministic.
+    '''
+
+    if method == 'uniform':
+        return uniform(nsamples, ndim, seed)
+    elif method == 'lhs':
+        return latin_hypercube(nsamples, ndim, seed)
+    elif method == 'halton':
+        return halton(nsamples, ndim)
+    elif method == 'sobol':
+        return sobol(nsamples, ndim)
+    else:
+        raise Exception('unknown sampling method: "%s"' % method)
@@ -4,9 +4,16 @@ import sys
 import time
 import threading
 from Queue import Queue, Empty
+from collections import OrderedDict, deque
 import tempfile
 import subprocess
 import signal
+import struct
+import select
+import fcntl
+import errno
+import hashlib
+import sqlite3
 from os.path import join as pjoin
 import shutil
 import logging
@@ -16,6 +23,7 @@ import progressbar
 
 import config
 import phase
+import source as source_model
 
 logger = logging.getLogger('kiwi.seismosizer')
 
@@ -51,6 +59,7 @@ class SeismosizerBase:
                 'set_spacial_undersampling',
                 'set_receivers',
                 'switch_receiver',
+                'switch_receivers',
                 'set_ref_seismograms',
                 'set_source_location',
                 'set_source_crustal_thickness_limit',
@@ -84,19 +93,63 @@ class SeismosizerBase:
                 'get_cached_traces_memory',
                 'set_cached_traces_memory_limit',
                 'set_verbose',
-                'set_ignore_sigint',]
-
-    def __init__(self, hosts):
+                'set_ignore_sigint',
+                'set_answer_format',]
+
+    # commands which only set state; a command is not sent to a process
+    # again, when it has been the last one of its kind sent there (see
+    # do_async()). The number gives the count of leading arguments
+    # selecting the state (receiver number); zero there means all receivers.
+    tracked_commands = { 'set_source_params': 0,
+                         'set_misfit_method': 0,
+                         'set_misfit_filter': 0,
+                         'set_misfit_filter_1': 1,
+                         'set_misfit_taper': 1,
+                         'switch_receiver': 1,
+                         'switch_receivers': 0 }
+
+    # commands after which the tracked state is no longer known
+    state_resets = { 'set_database': None,
+                     'set_receivers': None,
+                     'set_source_location': ['set_source_params'],
+                     'set_misfit_filter': ['set_misfit_filter_1'],
+                     'set_misfit_filter_1': ['set_misfit_filter'],
+                     'switch_receiver': ['switch_receivers'],
+                     'switch_receivers': ['switch_receiver'] }
+
+    def __init__(self, hosts, controller='threads'):
+        '''Start seismosizer processes on hosts.
+
+        With controller='threads', each process is controlled by its own
+        thread (SeismosizerProcess), with controller='eventloop' all processes
+        are controlled from a single thread (SeismosizerEventLoop).'''
 
         # start processes
-        processes = []
-        for host in hosts:
-            p = SeismosizerProcess( host )
-            processes.append(p)
+        self.eventloop = None
+        if controller == 'threads':
+            processes = [ SeismosizerProcess(host) for host in hosts ]
+
+        elif controller == 'eventloop':
+            self.eventloop = SeismosizerEventLoop()
+            processes = [ self.eventloop.add(host) for host in hosts ]
+            self.eventloop.start()
+
+        else:
+            raise Exception('Unknown seismosizer controller: %s' % controller)
 
         self.tempdir = tempfile.mkdtemp("","seismosizer-")
 
         self.processes = processes
+        self._index_by_tid = dict([ (p.tid, i) for (i, p) in enumerate(processes) ])
+
+        # accumulated time each process has been working on commands
+        self.busy_times = num.zeros(len(processes), dtype=num.float)
+
+        # last tracked state commands sent, by process, and number of
+        # round trips saved by not repeating them
+        self._sent_state = dict([ (p.tid, {}) for p in processes ])
+        self.nsuppressed = 0
+
         signal.signal(signal.SIGINT, self.sighandler)
         signal.signal(signal.SIGTERM, self.sighandler)
         signal.signal(signal.SIGQUIT, self.sighandler)
@@ -131,53 +184,264 @@ class SeismosizerBase:
            on group of processes: s.do( ['command','arg' ], where=range(1,4) )
         '''
 
+        return self.do_async(cmd, where=where).result()
+
+    def do_async(self, cmd, where=None):
+        '''Like do(), but return immediately with a SeismosizerFuture.
+
+           The answers are available through the future's result() method.
+           Commands sent to the same process are executed in the order
+           they have been issued.
+        '''
+
+        processes = self._select(where)
+        strcommand = command_to_str(cmd)
+        key = self._state_key(cmd)
+
+        # distribute command to each process
+        future = SeismosizerFuture(self, processes)
+        for p in processes:
+            sent = self._sent_state[p.tid]
+            if key is not None and sent.get(key) == strcommand:
+                logger.debug('Skip (%i): %s' % (p.tid, strcommand))
+                self.nsuppressed += 1
+                future._deliver(p, '')
+                continue
+
+            self._update_state(sent, cmd, key, strcommand)
+            self._command_sent(cmd)
+            logger.debug('Do (%i): %s' % (p.tid, strcommand))
+            p.push(strcommand, future)
+
+        if key is not None:
+            future.add_done_callback(
+                lambda future: self._forget_failed(future, key, strcommand))
+
+        return future
+
+    def do_batch(self, cmds, where=None):
+        '''Parallel execution of a block of commands on selected processes.
+
+           The whole block is sent to each process in a single request and
+           the answers are returned as one list per process. A command which
+           fails does not abort the block; its answer is the
+           SeismosizerReturnedError instance instead of a string.
+
+           s.do_batch( [ ['command1','arg'], ['command2'] ], where=range(1,4) )
+        '''
+
+        return self.do_batch_async(cmds, where=where).result()
+
+    def do_batch_async(self, cmds, where=None):
+        '''Like do_batch(), but return immediately with a SeismosizerFuture.'''
+
+        processes = self._select(where)
+        strcommands = [ command_to_str(cmd) for cmd in cmds ]
+
+        future = SeismosizerFuture(self, processes)
+        for p in processes:
+            # answers of the block are not checked here, so forget about
+            # the state set by it
+            for cmd in cmds:
+                self._update_state(self._sent_state[p.tid], cmd, None, None)
+                self._command_sent(cmd)
+
+            logger.debug('Do batch (%i): %i commands' % (p.tid, len(strcommands)))
+            p.push(strcommands, future)
+
+        return future
+
+    def _state_key(self, cmd):
+        '''Key identifying the state set by cmd, None if it is not tracked.'''
+
+        command = cmd[0]
+        if command not in self.tracked_commands:
+            return None
+
+        nargs = self.tracked_commands[command]
+        key = (command,) + tuple([ int(arg) for arg in cmd[1:1+nargs] ])
+        if 0 in key[1:]:
+            return None
+
+        return key
+
+    def _update_state(self, sent, cmd, key, strcommand):
+        '''Update tracked state of a process, when cmd is sent to it.'''
+
+        command = cmd[0]
+        if command in self.state_resets:
+            resets = self.state_resets[command]
+            for k in sent.keys():
+                if resets is None or k[0] in resets:
+                    del sent[k]
+
+        if key is not None:
+            sent[key] = strcommand
+        elif command in self.tracked_commands:
+            for k in sent.keys():
+                if k[0] == command:
+                    del sent[k]
+
+    def _command_sent(self, cmd):
+        '''Called for each command, before it is sent to a process.'''
+
+        pass
+
+    def _forget_failed(self, future, key, strcommand):
+        '''State of processes which failed to execute a command is unknown.'''
+
+        for tid in future._errors:
+            sent = self._sent_state[tid]
+            if sent.get(key) == strcommand:
+                del sent[key]
+
+    def _select(self, where):
         if where is None:
-            processes = self.processes
+            return self.processes
         else:
             if isinstance(where, int):
-                processes = [ self.processes[where] ]
+                return [ self.processes[where] ]
             else:
-                processes = [ self.processes[i] for i in where ]
+                return [ self.processes[i] for i in where ]
 
-        strcommand  =  ' '.join( [str(arg) for arg in cmd ] )
+    def _account_durations(self, future):
+        for tid, duration in future.durations.iteritems():
+            if tid in self._index_by_tid:
+                self.busy_times[self._index_by_tid[tid]] += duration
 
-        # distribute command to each process
-        runners = []
-        ready = Queue()
-        for p in processes:
-            logger.debug('Do (%i): %s' % (p.tid, strcommand))
-            p.push(strcommand, ready)
-            runners.append(p)
+    def _died(self):
+        '''Called when a seismosizer thread has died while waiting for answers.'''
 
-        # gather answers
-        answers = {}
-        errors = {}
-        fatal = False
+        self.close()
+        time.sleep(1.0)
+        self.terminate()
+        raise Fatal('Shit happens!')
+
+class SeismosizerFuture:
+    '''Pending answers of a command sent to a group of seismosizer processes.
+
+       Created by SeismosizerBase.do_async() and do_batch_async(). The
+       processes deliver their answers from their threads; result() blocks
+       until all of them have answered.
+    '''
+
+    def __init__(self, seismosizer, processes):
+        self._seismosizer = seismosizer
+        self._pending = list(processes)
+        self._answers = {}
+        self._errors = {}
+        self.durations = {}
+        self._dead = False
+        self._finished = False
+        self._accounted = False
+        self._callbacks = []
+        self._condition = threading.Condition()
+        if not self._pending:
+            self._finished = True
+
+    def _deliver(self, p, answer, duration=None):
+        '''Store answer of process p; answer None means that p has died.
+
+        duration is the time p has spent working on the command.'''
+
+        self._condition.acquire()
         try:
-            while runners:
-                p = ready.get()
-                if not p:
-                    raise ThreadIsDead()
+            if duration is not None:
+                self.durations[p.tid] = duration
 
-                runners.remove(p)
-                try:
-                    answer = p.poll()
-                    answers[p.tid] = answer
-                    logger.debug('Answer (%i): %s' % (p.tid, answer))
+            if answer is None:
+                self._dead = True
+            elif is_error(answer):
+                self._errors[p.tid] = answer.args[1]
+            else:
+                self._answers[p.tid] = answer
+                logger.debug('Answer (%i): %s' % (p.tid, answer))
 
-                except SeismosizerReturnedError, error:
-                    errors[p.tid] = error.args[1]
+            if p in self._pending:
+                self._pending.remove(p)
 
-        except ThreadIsDead:
-            self.close()
-            time.sleep(1.0)
-            self.terminate()
-            raise Fatal('Shit happens!')
+            if self._finished or (self._pending and not self._dead):
+                return
 
-        if errors:
-            raise SeismosizersReturnedErrors(errors)
+            self._finished = True
+            self._condition.notifyAll()
+            callbacks = self._callbacks
+            self._callbacks = []
+
+        finally:
+            self._condition.release()
+
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        '''Call callback(future) when all answers are in (maybe immediately).'''
+
+        self._condition.acquire()
+        try:
+            if not self._finished:
+                self._callbacks.append(callback)
+                return
+        finally:
+            self._condition.release()
+
+        callback(self)
 
-        return [ answers[i] for i in sorted(answers.keys()) ]
+    def done(self):
+        return self._finished
+
+    def wait(self):
+        self._condition.acquire()
+        try:
+            while not self._finished:
+                self._condition.wait()
+        finally:
+            self._condition.release()
+
+    def result(self):
+        '''Wait for the answers and return them, sorted by process.'''
+
+        self.wait()
+        if not self._accounted:
+            self._accounted = True
+            self._seismosizer._account_durations(self)
+
+        if self._dead:
+            self._seismosizer._died()
+
+        if self._errors:
+            raise SeismosizersReturnedErrors(self._errors)
+
+        return [ self._answers[i] for i in sorted(self._answers.keys()) ]
+
+def gather(futures):
+    '''Wait for all futures and return the list of their results.'''
+
+    return [ future.result() for future in futures ]
+
+def as_completed(futures):
+    '''Iterate over futures in the order in which they complete.'''
+
+    completed = Queue()
+    for future in futures:
+        future.add_done_callback(completed.put)
+
+    for i in xrange(len(futures)):
+        yield completed.get()
+
+def command_to_str(cmd):
+    return ' '.join( [str(arg) for arg in cmd ] )
+
+def is_error(answer):
+    return isinstance(answer, SeismosizerReturnedError)
+
+def answer_values(answer):
+    '''Get numbers from answer, which may be in text or binary format.'''
+
+    if isinstance(answer, num.ndarray):
+        return answer
+
+    return num.fromstring(answer, dtype=num.float, sep=' ')
 
 # add commands as methods
 def gen_do_method(command):
@@ -187,9 +451,18 @@ def gen_do_method(command):
     func.command = command
     return func
 
+def gen_do_async_method(command):
+    def func(self, *args, **kwargs):
+        return self.do_async( (func.command,)+args, **kwargs )
+
+    func.command = command
+    return func
+
 for command in SeismosizerBase.commands:
     method = gen_do_method(command)
     setattr( SeismosizerBase, 'do_'+command, method )
+    method = gen_do_async_method(command)
+    setattr( SeismosizerBase, 'do_'+command+'_async', method )
 
 class SeismosizersReturnedErrors(Exception):
     pass
@@ -209,6 +482,23 @@ class SeismosizersDied(Exception):
 class SeismosizerInsane(Exception):
     pass
 
+def spawn_seismosizer(host):
+    '''Start seismosizer program on host, connected through pipes.'''
+
+    if host == 'localhost':
+        cmd = [config.seismosizer_prog]
+    else:
+        cmd = [ 'ssh', host, config.seismosizer_prog ]
+
+    try:
+        return subprocess.Popen( cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, close_fds=True )
+    except:
+        raise Fatal("cannot start %s on %s" % (config.seismosizer_prog, host))
+
+def returned_error(p, line, error_str):
+    return SeismosizerReturnedError("%s on %s (tid=%i) failed doing command: %s" %
+                (config.seismosizer_prog, p.host, p.tid, line), error_str )
+
 class SeismosizerProcess(threading.Thread):
     '''Controls a single seismosizer process in a thread.'''
 
@@ -221,25 +511,13 @@ class SeismosizerProcess(threading.Thread):
         SeismosizerProcess.tid += 1
         self.host = host
 
-        cmd = [config.source_info_prog]
-
         self.tempdir = tempfile.mkdtemp("","seismosizer-process-")
 
-        if host == 'localhost':
-            cmd = [config.seismosizer_prog]
-        else:
-            cmd = [ 'ssh', host, config.seismosizer_prog ]
-
-        try:
-            p = subprocess.Popen( cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, close_fds=True )
-            self.p = p
-            self.to_p = p.stdin
-            self.from_p = p.stdout
-        except:
-            raise Fatal("cannot start %s on %s" % (config.seismosizer_prog, self.host))
+        self._spawn()
 
+        self.journal = CommandJournal()
+        self.nrespawns = 0
         self.commands = Queue()
-        self.answers = Queue()
         self.the_end_has_come = False
         self.have_sent_term_signal = False
         self.start()
@@ -251,6 +529,42 @@ class SeismosizerProcess(threading.Thread):
         import shutil
         shutil.rmtree(self.tempdir)
 
+    def _spawn(self):
+        self.p = spawn_seismosizer(self.host)
+        self.to_p = self.p.stdin
+        self.from_p = self.p.stdout
+
+    def _respawn(self):
+        '''Replace dead seismosizer by a new one and bring it to the same state.'''
+
+        if self.p.poll() is None:
+            try:
+                os.kill(self.p.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+        for f in (self.to_p, self.from_p):
+            try:
+                f.close()
+            except IOError:
+                pass
+
+        self.p.wait()
+
+        try:
+            self._spawn()
+        except Fatal, e:
+            raise SeismosizerDied(str(e))
+
+        lines = self.journal.lines()
+        logger.warn('Respawned seismosizer %i on %s, replaying %i commands' % (self.tid, self.host, len(lines)))
+        for line in lines:
+            self.to_p.write(line+"\n")
+            self.to_p.flush()
+            answer = self._read_answer(line, record=False)
+            if is_error(answer):
+                raise SeismosizerInsane('Seismosizer %i failed to replay command: %s' % (self.tid, line))
+
     def stop(self):
        self.the_end_has_come = True
        self.commands.put(('close',None))
@@ -268,32 +582,35 @@ class SeismosizerProcess(threading.Thread):
 
     def run(self):
         logger.debug('Starting seismosizer %i.' % self.tid)
-        ready = None
+        future = None
         try:
             while True:
-                retcode = self.p.poll()
-                if retcode is not None:
-                    raise SeismosizerDied('Seismosizer %i died or has been killed. Exit status: %i' % (self.tid, retcode))
-
                 self.check_end()
-                cmd, ready = self.commands.get()
+                cmd, future = self.commands.get()
 
                 if cmd == 'close':
                     break
 
                 else:
-                    answer = self._do(cmd)
-                    self.answers.put(answer)
-                    ready.put(self)
-                    ready = None
-
-
+                    tstart = time.time()
+                    answer = self._execute(cmd)
+                    future._deliver(self, answer, time.time()-tstart)
+                    future = None
 
         except (IOError, SeismosizerDied, SeismosizerInsane), e:
             logger.warn( e )
             self.the_end_has_come = True
-            if ready is not None:
-                ready.put(None)
+            if future is not None:
+                future._deliver(self, None)
+
+        # nobody is going to answer commands which are still queued
+        while True:
+            try:
+                cmd, future = self.commands.get_nowait()
+                if future is not None:
+                    future._deliver(self, None)
+            except Empty:
+                break
 
         self.to_p.close()
         self.from_p.close()
@@ -303,57 +620,856 @@ class SeismosizerProcess(threading.Thread):
 
         logger.debug('Seismosizer %i finished.' % self.tid)
 
+    def _execute(self, cmd):
+        '''Run command or block of commands, respawning the seismosizer if it dies.
+
+        After a respawn, the journal is replayed to the new seismosizer and
+        the command is retried. Of a block, only the commands which have not
+        been answered yet are retried.'''
+
+        done = []
+        nattempts = 0
+        while True:
+            try:
+                retcode = self.p.poll()
+                if retcode is not None:
+                    raise SeismosizerDied('Seismosizer %i died or has been killed. Exit status: %i' % (self.tid, retcode))
+
+                if isinstance(cmd, list):
+                    return self._do_batch(cmd, done)
+                else:
+                    return self._do(cmd)
+
+            except (IOError, SeismosizerDied, SeismosizerInsane), e:
+                if self.the_end_has_come or nattempts >= config.seismosizer_max_respawns:
+                    raise
+
+                logger.warn( e )
+                nattempts += 1
+                self.nrespawns += 1
+                try:
+                    self._respawn()
+                except (IOError, SeismosizerDied, SeismosizerInsane), e:
+                    logger.warn( e )
+
     def _do(self, command):
         '''Put command to minimizer and return the results'''
 
-        answer = None
         line = command.strip()
 
         self.to_p.write(line+"\n")
         self.to_p.flush()
 
-        answer = ''
+        return self._read_answer(line)
+
+    def _do_batch(self, commands, done=None):
+        '''Put block of commands to minimizer and return list of results.
+
+        All commands are written before the first answer is read, so the
+        block must fit into the pipe buffer (see Seismosizer.batch_size).
+        Answers are appended to done; commands already answered in done
+        are skipped.'''
+
+        if done is None:
+            done = []
+
+        lines = [ command.strip() for command in commands[len(done):] ]
+
+        self.to_p.write(''.join([ line+"\n" for line in lines ]))
+        self.to_p.flush()
+
+        for line in lines:
+            done.append(self._read_answer(line))
+
+        return done
+
+    def _read_answer(self, line, record=True):
+        '''Read answer of minimizer to command line.
+
+        Successful state-setting commands are recorded in the journal,
+        unless record is False. Raises SeismosizerDied, if the minimizer
+        exits or does not answer within config.seismosizer_timeout.'''
+
+        self._wait_answer()
         retval = self.from_p.readline().rstrip()
         self.check_end()
 
+        if not retval:
+            raise SeismosizerDied('Seismosizer %i on %s did not answer.' % (self.tid, self.host))
+
         if retval.endswith('nok'):
-            return SeismosizerReturnedError("%s on %s (tid=%i) failed doing command: %s" %
-                        (config.seismosizer_prog, self.host, self.tid, line), '' )
+            return returned_error(self, line, '')
 
         elif retval.endswith('nok >'):
+            self._wait_answer()
             error_str = self.from_p.readline().rstrip()
             self.check_end()
-            return SeismosizerReturnedError("%s on %s (tid=%i) failed doing command: %s" %
-                        (config.seismosizer_prog, self.host, self.tid, line), error_str )
+            return returned_error(self, line, error_str)
 
         elif retval.endswith('ok >'):
+            self._wait_answer()
             answer = self.from_p.readline().rstrip()
             self.check_end()
+            if record:
+                self.journal.record(line, answer)
             return answer
 
         elif retval.endswith('ok'):
+            if record:
+                self.journal.record(line, '')
             return ''
 
+        elif retval.endswith('ok b'):
+            nvalues = struct.unpack('<i', self._read_bytes(4))[0]
+            return num.frombuffer(self._read_bytes(8*nvalues), dtype='<f8')
+
         else:
             raise SeismosizerInsane('Seismosizer %i did not answer correctly.' % self.tid)
 
+    def _wait_answer(self):
+        '''Wait until the minimizer has something to say.
+
+        The pipe is unbuffered, so nothing can be waiting on our side.'''
+
+        timeout = config.seismosizer_timeout
+        if timeout is None:
+            return
+
+        while True:
+            try:
+                readable = select.select([self.from_p], [], [], timeout)[0]
+                break
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+
+        if not readable:
+            raise SeismosizerDied('Seismosizer %i on %s did not answer within %g s.' % (self.tid, self.host, timeout))
+
+    def _read_bytes(self, n):
+        self._wait_answer()
+        data = self.from_p.read(n)
+        self.check_end()
+        if len(data) != n:
+            raise SeismosizerDied('Seismosizer %i on %s did not answer.' % (self.tid, self.host))
+
+        return data
+
     def check_end(self):
         if self.the_end_has_come:
             mess = '"You gotta go when you gotta go!", says process %i' % self.tid
 
             raise SeismosizerInsane(mess)
 
-    def push(self, cmd, ready):
-        '''Enqueue command for seismosizer.'''
-        self.commands.put((cmd, ready))
+    def push(self, cmd, future):
+        '''Enqueue command for seismosizer.
 
-    def poll(self):
-        '''Check for results of commands.'''
-        if not self.isAlive(): raise ThreadIsDead()
-        answer = self.answers.get()
-        if isinstance(answer, SeismosizerReturnedError):
-            raise answer
-        return answer
+        The answer is delivered to future, when it is ready.'''
+        if self.the_end_has_come or not self.isAlive():
+            future._deliver(self, None)
+            return
+
+        self.commands.put((cmd, future))
+
+def set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+class SeismosizerEventLoop(threading.Thread):
+    '''Controls many seismosizer processes from a single thread.
+
+    Instead of having a thread per process, blocking on its pipes, the pipes
+    of all processes are multiplexed with poll(). Commands are handed over
+    through the queues of the SeismosizerChannel objects created with add().'''
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.channels = []
+        self._channel_by_fd = {}
+        self._poll = select.poll()
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        self._wakeup_lock = threading.Lock()
+        set_nonblocking(self._wakeup_r)
+        set_nonblocking(self._wakeup_w)
+        self._poll.register(self._wakeup_r, select.POLLIN)
+
+    def add(self, host):
+        channel = SeismosizerChannel(self, host)
+        self.channels.append(channel)
+        return channel
+
+    def wakeup(self):
+        self._wakeup_lock.acquire()
+        try:
+            # the descriptor must not be used after the loop has closed it
+            if self._wakeup_w is not None:
+                os.write(self._wakeup_w, 'x')
+        except OSError:
+            pass # pipe is full, loop is going to wake up anyway
+        finally:
+            self._wakeup_lock.release()
+
+    def watch(self, fd, channel, events):
+        self._poll.register(fd, events)
+        self._channel_by_fd[fd] = channel
+
+    def unwatch(self, fd):
+        if fd in self._channel_by_fd:
+            self._poll.unregister(fd)
+            del self._channel_by_fd[fd]
+
+    def run(self):
+        logger.debug('Starting seismosizer event loop.')
+        while True:
+            for channel in self.channels:
+                channel.step()
+
+            if not [ c for c in self.channels if not c.finished ]:
+                break
+
+            timeout = config.seismosizer_timeout
+            if timeout is None:
+                events_ready = self._poll.poll()
+            else:
+                events_ready = self._poll.poll(timeout*1000.)
+
+            for fd, events in events_ready:
+                if fd == self._wakeup_r:
+                    try:
+                        while os.read(self._wakeup_r, 4096):
+                            pass
+                    except OSError:
+                        pass
+
+                elif fd in self._channel_by_fd:
+                    channel = self._channel_by_fd[fd]
+                    try:
+                        channel.handle(fd, events)
+                    except (IOError, OSError, SeismosizerDied, SeismosizerInsane), e:
+                        channel.failed(e)
+
+            if timeout is not None:
+                now = time.time()
+                for channel in self.channels:
+                    if not channel.finished and channel._expect and now - channel._tlast > timeout:
+                        channel.failed(SeismosizerDied('Seismosizer %i on %s did not answer within %g s.' %
+                                                       (channel.tid, channel.host, timeout)))
+
+        self._wakeup_lock.acquire()
+        try:
+            os.close(self._wakeup_r)
+            os.close(self._wakeup_w)
+            self._wakeup_r = self._wakeup_w = None
+        finally:
+            self._wakeup_lock.release()
+        logger.debug('Seismosizer event loop finished.')
+
+class SeismosizerChannel:
+    '''Controls a single seismosizer process within a SeismosizerEventLoop.
+
+    Provides the same interface to SeismosizerBase as SeismosizerProcess.'''
+
+    def __init__(self, loop, host):
+        self.tid = SeismosizerProcess.tid
+        SeismosizerProcess.tid += 1
+        self.host = host
+        self.loop = loop
+
+        self.journal = CommandJournal()
+        self.nrespawns = 0
+        self.commands = deque()
+        self.the_end_has_come = False
+        self.have_sent_term_signal = False
+        self.finished = False
+        self._lock = threading.Lock()
+
+        # current command: [cmd, future, lines, answers, tstart]
+        self._job = None
+        self._nattempts = 0
+        self._spawn()
+
+    def _spawn(self):
+        self.p = spawn_seismosizer(self.host)
+        self._fd_to = self.p.stdin.fileno()
+        self._fd_from = self.p.stdout.fileno()
+        set_nonblocking(self._fd_to)
+        set_nonblocking(self._fd_from)
+        self._outbuf = ''
+        self._inbuf = ''
+        self._expect = deque()
+        self._header = None
+        self._nbinary = None
+        # time of the last answer, or of the request, if none was pending
+        self._tlast = time.time()
+        self.loop.watch(self._fd_from, self, select.POLLIN)
+
+    def _close_pipes(self):
+        self.loop.unwatch(self._fd_to)
+        self.loop.unwatch(self._fd_from)
+        for f in (self.p.stdin, self.p.stdout):
+            try:
+                f.close()
+            except IOError:
+                pass
+
+    def push(self, cmd, future):
+        '''Enqueue command for seismosizer.
+
+        The answer is delivered to future, when it is ready.'''
+
+        self._lock.acquire()
+        try:
+            dead = self.the_end_has_come or self.finished
+            if not dead:
+                self.commands.append((cmd, future))
+        finally:
+            self._lock.release()
+
+        if dead:
+            future._deliver(self, None)
+        else:
+            self.loop.wakeup()
+
+    def stop(self):
+        self.the_end_has_come = True
+        self.loop.wakeup()
+
+    def terminate(self):
+        if not self.have_sent_term_signal:
+            if self.p.poll() is None:
+                try:
+                    os.kill(self.p.pid, signal.SIGTERM)
+                    logger.warn( 'Sent SIGTERM to seismosizer %i, pid %i' % (self.tid, self.p.pid) )
+                except OSError, error:
+                    logger.warn( error )
+
+            self.have_sent_term_signal = True
+
+    def step(self):
+        '''Called by the event loop: start next command or shut down.'''
+
+        if self.finished:
+            return
+
+        if self.the_end_has_come:
+            if self._job is not None:
+                logger.warn('"You gotta go when you gotta go!", says process %i' % self.tid)
+            self._shutdown()
+            return
+
+        if self._job is None and self.commands:
+            cmd, future = self.commands.popleft()
+            if isinstance(cmd, list):
+                lines = [ c.strip() for c in cmd ]
+            else:
+                lines = [ cmd.strip() ]
+
+            self._job = [cmd, future, lines, [], time.time()]
+            self._send(lines, 'job')
+
+    def handle(self, fd, events):
+        '''Called by the event loop when a pipe of this channel is ready.'''
+
+        if fd == self._fd_to:
+            if events & (select.POLLERR | select.POLLHUP | select.POLLNVAL):
+                raise SeismosizerDied('Seismosizer %i on %s closed its input.' % (self.tid, self.host))
+
+            n = os.write(self._fd_to, self._outbuf)
+            self._outbuf = self._outbuf[n:]
+            if not self._outbuf:
+                self.loop.unwatch(self._fd_to)
+
+        elif fd == self._fd_from:
+            try:
+                data = os.read(self._fd_from, 65536)
+            except OSError, e:
+                if e.errno == errno.EAGAIN:
+                    return
+                raise
+
+            if not data:
+                raise SeismosizerDied('Seismosizer %i on %s did not answer.' % (self.tid, self.host))
+
+            self._tlast = time.time()
+            self._inbuf += data
+            while True:
+                if self._nbinary is not None:
+                    if not self._read_binary():
+                        break
+
+                elif '\n' in self._inbuf:
+                    retval, self._inbuf = self._inbuf.split('\n', 1)
+                    self._read_line(retval.rstrip())
+
+                else:
+                    break
+
+    def failed(self, e):
+        '''Called by the event loop when the seismosizer died or went insane.
+
+        Like SeismosizerProcess, the seismosizer is respawned and the journal
+        is replayed, before the unanswered commands are sent again.'''
+
+        logger.warn( e )
+        while not self.the_end_has_come and self._nattempts < config.seismosizer_max_respawns:
+            self._nattempts += 1
+            self.nrespawns += 1
+            try:
+                self._respawn()
+                return
+            except (IOError, OSError, SeismosizerDied, Fatal), e:
+                logger.warn( e )
+
+        self.the_end_has_come = True
+        self._shutdown()
+
+    def _respawn(self):
+        if self.p.poll() is None:
+            try:
+                os.kill(self.p.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+        self._close_pipes()
+        self.p.wait()
+
+        try:
+            self._spawn()
+        except Fatal, e:
+            raise SeismosizerDied(str(e))
+
+        lines = self.journal.lines()
+        logger.warn('Respawned seismosizer %i on %s, replaying %i commands' % (self.tid, self.host, len(lines)))
+        self._send(lines, 'replay')
+        if self._job is not None:
+            lines, answers = self._job[2:4]
+            self._send(lines[len(answers):], 'job')
+
+    def _send(self, lines, kind):
+        if not lines:
+            return
+
+        if not self._outbuf:
+            self.loop.watch(self._fd_to, self, select.POLLOUT)
+
+        if not self._expect:
+            self._tlast = time.time()
+
+        self._outbuf += ''.join([ line+"\n" for line in lines ])
+        self._expect.extend([ (line, kind) for line in lines ])
+
+    def _read_line(self, retval):
+        '''Interpret line from seismosizer (see SeismosizerProcess._read_answer()).'''
+
+        if not self._expect:
+            raise SeismosizerInsane('Seismosizer %i said something unexpected.' % self.tid)
+
+        line, kind = self._expect[0]
+
+        if self._header is not None:
+            header, self._header = self._header, None
+            if header.endswith('nok >'):
+                self._answered(returned_error(self, line, retval))
+            else:
+                self._answered(retval)
+
+        elif retval.endswith('nok'):
+            self._answered(returned_error(self, line, ''))
+
+        elif retval.endswith('nok >') or retval.endswith('ok >'):
+            self._header = retval
+
+        elif retval.endswith('ok'):
+            self._answered('')
+
+        elif retval.endswith('ok b'):
+            self._nbinary = -1
+
+        else:
+            raise SeismosizerInsane('Seismosizer %i did not answer correctly.' % self.tid)
+
+    def _read_binary(self):
+        '''Try to complete binary answer from input buffer.'''
+
+        if self._nbinary == -1:
+            if len(self._inbuf) < 4:
+                return False
+
+            self._nbinary = 8*struct.unpack('<i', self._inbuf[:4])[0]
+            self._inbuf = self._inbuf[4:]
+
+        if len(self._inbuf) < self._nbinary:
+            return False
+
+        data, self._inbuf = self._inbuf[:self._nbinary], self._inbuf[self._nbinary:]
+        self._nbinary = None
+        self._answered(num.frombuffer(data, dtype='<f8'))
+        return True
+
+    def _answered(self, answer):
+        line, kind = self._expect.popleft()
+
+        if kind == 'replay':
+            if is_error(answer):
+                raise SeismosizerInsane('Seismosizer %i failed to replay command: %s' % (self.tid, line))
+            return
+
+        if not is_error(answer):
+            self.journal.record(line, answer)
+
+        cmd, future, lines, answers, tstart = self._job
+        answers.append(answer)
+        if len(answers) == len(lines):
+            self._job = None
+            self._nattempts = 0
+            if isinstance(cmd, list):
+                future._deliver(self, answers, time.time()-tstart)
+            else:
+                future._deliver(self, answers[0], time.time()-tstart)
+
+    def _shutdown(self):
+        self._lock.acquire()
+        try:
+            self.finished = True
+            queued = list(self.commands)
+            self.commands.clear()
+        finally:
+            self._lock.release()
+
+        # nobody is going to answer the current and the queued commands
+        if self._job is not None:
+            queued.insert(0, self._job[:2])
+            self._job = None
+
+        for cmd, future in queued:
+            future._deliver(self, None)
+
+        self._close_pipes()
+        retcode = self.p.wait()
+        if retcode != 0:
+            logger.error('Seismosizer %i exited with nonzero exit status: %i' % (self.tid, retcode))
+
+        logger.debug('Seismosizer %i finished.' % self.tid)
+
+class CommandJournal:
+    '''Record of the state-setting commands a seismosizer has executed.
+
+    Replaying the journal to a fresh seismosizer brings it to the same
+    state. Commands which are superseded by later ones are dropped, so the
+    journal does not grow with the number of sources tried.'''
+
+    # commands changing the state of the seismosizer
+    state_commands = set(['set_database',
+                          'set_local_interpolation',
+                          'set_spacial_undersampling',
+                          'set_receivers',
+                          'switch_receiver',
+                          'switch_receivers',
+                          'set_ref_seismograms',
+                          'set_source_location',
+                          'set_source_crustal_thickness_limit',
+                          'set_source_params',
+                          'set_source_params_mask',
+                          'set_source_subparams',
+                          'set_source_constraints',
+                          'set_effective_dt',
+                          'set_misfit_method',
+                          'set_misfit_filter',
+                          'set_misfit_filter_1',
+                          'set_misfit_taper',
+                          'set_synthetics_factor',
+                          'shift_ref_seismogram',
+                          'set_floating_shiftrange',
+                          'set_cached_traces_memory_limit',
+                          'set_verbose',
+                          'set_ignore_sigint',
+                          'set_answer_format'])
+
+    # commands whose first argument is a receiver number (0: all receivers)
+    per_receiver_commands = set(['switch_receiver',
+                                 'set_misfit_filter_1',
+                                 'set_misfit_taper',
+                                 'shift_ref_seismogram',
+                                 'set_floating_shiftrange'])
+
+    # commands which reset the effect of other commands
+    resets = { 'set_receivers': per_receiver_commands | set(['set_ref_seismograms', 'switch_receivers']),
+               'switch_receivers': set(['switch_receiver']),
+               'set_ref_seismograms': set(['shift_ref_seismogram']),
+               'set_misfit_filter': set(['set_misfit_filter_1']) }
+
+    def __init__(self):
+        self._entries = OrderedDict()
+
+    def record(self, line, answer):
+        toks = line.split()
+        command, args = toks[0], toks[1:]
+
+        if command == 'autoshift_ref_seismogram':
+            # replay the resulting shifts instead of a new autoshift
+            irec = int(args[0])
+            for ishift, shift in enumerate(answer.split()):
+                if irec == 0:
+                    self._shift(ishift+1, float(shift))
+                else:
+                    self._shift(irec, float(shift))
+            return
+
+        if command not in CommandJournal.state_commands:
+            return
+
+        if command in CommandJournal.resets:
+            self._drop(CommandJournal.resets[command])
+
+        if command in CommandJournal.per_receiver_commands:
+            irec = int(args[0])
+            if command == 'shift_ref_seismogram':
+                self._shift(irec, float(args[1]))
+                return
+
+            if irec == 0:
+                self._drop([command])
+
+            key = (command, irec)
+
+        else:
+            key = (command,)
+
+        # a command given again takes effect where it was given first;
+        # commands depending on it are dropped through the resets table
+        self._entries[key] = line
+
+    def lines(self):
+        return self._entries.values()
+
+    def _shift(self, irec, shift):
+        key = ('shift_ref_seismogram', irec)
+        if key in self._entries:
+            shift += float(self._entries[key].split()[2])
+
+        self._entries[key] = 'shift_ref_seismogram %i %s' % (irec, repr(shift))
+
+    def _drop(self, commands):
+        for key in self._entries.keys():
+            if key[0] in commands:
+                del self._entries[key]
+
+class PruneBound:
+    '''Best global misfit and norm estimates found by pruned computations.
+
+    Pass the same object to consecutive calls of make_misfits_for_sources()
+    with prune_margin, e.g. for the blocks of one grid search, so that later
+    calls prune against the best source found so far, instead of probing
+    for a bound of their own. The outer misfit config and the set of
+    enabled receivers must not change in between.'''
+
+    def __init__(self):
+        self.best = None
+        self.norms = None
+
+    def known(self):
+        return self.best is not None
+
+    def update(self, misfits, nterms):
+        '''Include global misfits and misfit terms of completed sources.'''
+
+        misfits = misfits[num.isfinite(misfits)]
+        if misfits.size == 0:
+            return
+
+        if self.best is None:
+            self.best = num.min(misfits)
+            self.norms = num.max(nterms, 0)
+        else:
+            self.best = min(self.best, num.min(misfits))
+            self.norms = num.maximum(self.norms, num.max(nterms, 0))
+
+class MisfitCache:
+    '''LRU cache of the misfits and norms of sources, by receiver and component.
+
+    Entries are keyed by the source, as sent to the seismosizers, and the
+    set of enabled receivers. The cache must be cleared, whenever anything
+    else influencing the misfits changes (see Seismosizer._command_sent()).'''
+
+    def __init__(self, size):
+        self.size = size
+        self._entries = OrderedDict()
+        self.nhits = 0
+        self.nmisses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        '''Get (misfits, norms) stored for key, (None, None) for a failing
+        source, or None if key is unknown.'''
+
+        if key not in self._entries:
+            self.nmisses += 1
+            return None
+
+        self.nhits += 1
+        value = self._entries.pop(key)
+        self._entries[key] = value
+        return value
+
+    def put(self, key, misfits, norms):
+        if self.size <= 0:
+            return
+
+        if key in self._entries:
+            del self._entries[key]
+
+        self._entries[key] = (misfits, norms)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        return { 'hits': self.nhits, 'misses': self.nmisses, 'entries': len(self._entries) }
+
+class MisfitStore:
+    '''Persistent store of the misfits and norms of sources, in an sqlite file.
+
+    Same interface as MisfitCache, but entries survive the program run.
+    Besides the source and the set of enabled receivers, they are keyed by
+    a fingerprint of everything else influencing the misfits (Greens
+    functions, reference seismograms, tapers, filters, inner norm, ...),
+    which has to be provided by the caller. Entries with other fingerprints
+    are kept, so that a file may be shared by several configurations.
+
+    New entries are written to the file by flush(). If max_entries is set,
+    flush() then drops the oldest entries beyond that number, whatever
+    their fingerprint. prune() drops the entries of other fingerprints.'''
+
+    def __init__(self, filename, fingerprint, max_entries=None):
+        self.filename = filename
+        self.fingerprint = fingerprint
+        self.max_entries = max_entries
+        self._db = sqlite3.connect(filename)
+        self._db.execute('''CREATE TABLE IF NOT EXISTS misfits (
+                                fingerprint TEXT,
+                                enabled TEXT,
+                                source TEXT,
+                                nreceivers INTEGER,
+                                ncomponents INTEGER,
+                                misfits BLOB,
+                                norms BLOB,
+                                PRIMARY KEY (fingerprint, enabled, source))''')
+        self._db.commit()
+        self._pending = []
+        self.nhits = 0
+        self.nmisses = 0
+
+    def __len__(self):
+        cur = self._db.execute('SELECT COUNT(*) FROM misfits WHERE fingerprint = ?',
+                               (self.fingerprint,))
+        return cur.fetchone()[0]
+
+    def _row_key(self, key):
+        enabled, source = key
+        return (self.fingerprint, ''.join([ '01'[bool(e)] for e in enabled ]), source)
+
+    def get(self, key):
+        '''Get (misfits, norms) stored for key, (None, None) for a failing
+        source, or None if key is unknown.'''
+
+        cur = self._db.execute('''SELECT nreceivers, ncomponents, misfits, norms FROM misfits
+                                  WHERE fingerprint = ? AND enabled = ? AND source = ?''',
+                               self._row_key(key))
+        row = cur.fetchone()
+        if row is None:
+            self.nmisses += 1
+            return None
+
+        self.nhits += 1
+        nreceivers, ncomponents, misfits, norms = row
+        if misfits is None:
+            return None, None
+
+        shape = (nreceivers, ncomponents)
+        return (num.frombuffer(str(misfits), dtype='<f8').reshape(shape).astype(num.float),
+                num.frombuffer(str(norms), dtype='<f8').reshape(shape).astype(num.float))
+
+    def put(self, key, misfits, norms):
+        if misfits is None:
+            row = self._row_key(key) + (0, 0, None, None)
+        else:
+            nreceivers, ncomponents = misfits.shape
+            row = self._row_key(key) + (nreceivers, ncomponents,
+                        buffer(num.asarray(misfits, dtype='<f8').tostring()),
+                        buffer(num.asarray(norms, dtype='<f8').tostring()))
+
+        self._pending.append(row)
+
+    def flush(self):
+        if self._pending:
+            self._db.executemany('INSERT OR REPLACE INTO misfits VALUES (?,?,?,?,?,?,?)',
+                                 self._pending)
+            self._pending = []
+            if self.max_entries is not None:
+                # rowids grow with insertion, replaced rows get new ones
+                self._db.execute('''DELETE FROM misfits WHERE rowid IN (
+                                        SELECT rowid FROM misfits ORDER BY rowid DESC LIMIT -1 OFFSET ?)''',
+                                 (int(self.max_entries),))
+            self._db.commit()
+
+    def prune(self):
+        '''Drop entries of other fingerprints, return their number.'''
+
+        cur = self._db.execute('DELETE FROM misfits WHERE fingerprint != ?', (self.fingerprint,))
+        self._db.commit()
+        self._db.execute('VACUUM')
+        return cur.rowcount
+
+    def close(self):
+        self.flush()
+        self._db.close()
+
+    def stats(self):
+        return { 'hits': self.nhits, 'misses': self.nmisses, 'entries': len(self) }
+
+def fingerprint(*things):
+    '''Hex digest of things, for MisfitStore.
+
+    Things are hashed by value: lists, tuples and dicts are traversed,
+    arrays are hashed by content, and other objects by their class and
+    attributes. Only numbers, strings, booleans and None are hashed by
+    their repr().'''
+
+    h = hashlib.md5()
+    def update(x):
+        if isinstance(x, num.ndarray):
+            h.update('array(%s, %s, ' % (x.dtype.str, x.shape))
+            h.update(num.ascontiguousarray(x).tostring())
+            h.update(')')
+        elif isinstance(x, (list, tuple)):
+            h.update('(')
+            for y in x:
+                update(y)
+                h.update(', ')
+            h.update(')')
+        elif isinstance(x, dict):
+            h.update('{')
+            for k in sorted(x.keys()):
+                update(k)
+                h.update(': ')
+                update(x[k])
+                h.update(', ')
+            h.update('}')
+        elif x is None or isinstance(x, (bool, int, long, float, str, unicode, num.number)):
+            h.update(repr(x))
+        elif hasattr(x, '__dict__'):
+            h.update('%s.%s(' % (x.__class__.__module__, x.__class__.__name__))
+            update(vars(x))
+            h.update(')')
+        else:
+            raise Exception('cannot fingerprint object of type %s' % type(x))
+
+    update(things)
+    return h.hexdigest()
 
 class NoValidSources(Exception):
     pass
@@ -371,19 +1487,86 @@ class Seismosizer(SeismosizerBase):
                       'set_source_constraints',
                       'set_effective_dt',
                       'set_synthetics_factor',
-                      'output_seismograms',
-                      'output_seismogram_spectra',
                       'output_source_model',
                       'output_distances',
-                      'output_cross_correlations',
                       'set_floating_shiftrange',
                       'get_cached_traces_memory',
                       'set_cached_traces_memory_limit',
                       'set_verbose',
                       'set_ignore_sigint']
 
-    def __init__(self, hosts, balance_method='123321'):
-        SeismosizerBase.__init__(self, hosts)
+    # these commands write per-receiver output files; when every process
+    # holds all receivers, only one of them is asked (see _query_where())
+    output_commands = ['output_seismograms',
+                       'output_seismogram_spectra',
+                       'output_cross_correlations']
+
+    # balance methods which keep all receivers enabled on every process
+    source_sharded_methods = ('sources', 'serial')
+
+    # commands which change the misfits computed for a source; sending
+    # one of these clears the misfit cache
+    misfit_state_commands = set(['set_database',
+                                 'set_local_interpolation',
+                                 'set_spacial_undersampling',
+                                 'set_receivers',
+                                 'set_ref_seismograms',
+                                 'set_source_location',
+                                 'set_source_crustal_thickness_limit',
+                                 'set_source_params_mask',
+                                 'set_source_subparams',
+                                 'set_source_constraints',
+                                 'set_effective_dt',
+                                 'set_misfit_method',
+                                 'set_misfit_filter',
+                                 'set_misfit_filter_1',
+                                 'set_misfit_taper',
+                                 'set_synthetics_factor',
+                                 'shift_ref_seismogram',
+                                 'autoshift_ref_seismogram',
+                                 'set_floating_shiftrange'])
+
+    # maximum number of per-receiver setup commands sent in one request;
+    # their answers are short, so such a block fits into the pipe buffer
+    setup_block_size = 1000
+
+    def __init__(self, hosts, balance_method='123321', batch_size=32,
+                 min_receivers_per_process=4, imbalance_limit=1.5,
+                 rebalance_interval=100, rebalance_tolerance=0.05,
+                 cost_regularization=0.3, cost_memory=20, controller='threads',
+                 binary_answers=False, misfit_cache_size=1000):
+        '''Start seismosizer processes on hosts.
+
+           controller is passed to SeismosizerBase: 'threads' or 'eventloop';
+           the latter is preferable when running many processes.
+
+           If binary_answers is True, the processes are asked to send
+           misfits, shifts, amplitudes and intensities in binary format (see
+           set_answer_format()). Text format is used if they refuse.
+
+           make_misfits_for_sources() keeps the results of the last
+           misfit_cache_size sources in a MisfitCache, so that sources which
+           are tried again are not recomputed. Set it to 0 to turn this off.
+
+           balance_method selects how work is distributed over the processes:
+
+             '123321', '112233', '123123': receivers are distributed over
+                 the processes (by distance), every source is computed by
+                 all processes together.
+             'sources': every process holds all receivers, and the sources
+                 given to make_misfits_for_sources() are dispatched to
+                 whichever process is free.
+             'auto': choose between '123321' and 'sources' from receiver
+                 count, number of processes and the measured costs of the
+                 processes per source (see _choose_balance_method()).
+             'adaptive': start like '123321', then estimate the cost of each
+                 receiver from the measured working times of the processes
+                 and move receivers between processes every
+                 rebalance_interval sources, to minimise the time of the
+                 slowest process (see _rebalance_adaptive()).
+        '''
+
+        SeismosizerBase.__init__(self, hosts, controller=controller)
         self.database = None
         self.receivers = None
         self.source = None
@@ -392,6 +1575,89 @@ class Seismosizer(SeismosizerBase):
         self.local_interpolation = None
         self.balance_method = balance_method
 
+        # number of sources sent to the processes in one request by
+        # make_misfits_for_sources(); the block of commands has to fit into
+        # the pipe buffer
+        self.batch_size = batch_size
+
+        # parameters for balance_method 'auto'
+        self.min_receivers_per_process = min_receivers_per_process
+        self.imbalance_limit = imbalance_limit
+        self.active_balance_method = None
+        self._balance_suspended = False
+
+        # accumulated (slowest, mean) process time per source, measured
+        # while receivers are distributed over the processes
+        self.source_costs = [0., 0.]
+        self.source_costs_count = 0
+
+        # set when sources are sharded because the measured costs were
+        # unequal; they cannot be measured again while sharded
+        self._imbalanced = False
+
+        # parameters and state for balance_method 'adaptive'
+        self.rebalance_interval = rebalance_interval
+        self.rebalance_tolerance = rebalance_tolerance
+        self.cost_regularization = cost_regularization
+        self.cost_memory = cost_memory
+        self.receiver_costs = None
+        self._receiver_costs_for = None
+        self._cost_observations = []
+        self._window_busy_times = None
+        self._window_nsources = 0
+
+        # cache for _get_answer_maps()
+        self._answer_maps = None
+
+        # last per-receiver setup commands, by receiver and command, see
+        # _set_receiver_commands()
+        self._receiver_commands = []
+
+        self.misfit_cache = MisfitCache(misfit_cache_size)
+
+        # optional persistent second level of the misfit cache, see
+        # set_misfit_store()
+        self.misfit_store = None
+
+        # set while receivers are handed over between processes
+        self._reassigning = False
+
+        self.binary_answers = False
+        if binary_answers:
+            self.set_answer_format('binary')
+
+    def set_answer_format(self, format):
+        '''Select text or binary format for numeric answers of the processes.
+
+        Falls back to text format, if any of the processes does not support
+        binary answers.'''
+
+        try:
+            self.do_set_answer_format(format)
+            self.binary_answers = format == 'binary'
+
+        except SeismosizersReturnedErrors:
+            logger.warn('Seismosizers do not support %s answers, using text.' % format)
+            try:
+                self.do_set_answer_format('text')
+            except SeismosizersReturnedErrors:
+                pass # these do not know about binary answers at all
+
+            self.binary_answers = False
+
+    def set_misfit_store(self, store):
+        '''Use a MisfitStore behind the misfit cache.
+
+        The fingerprint of the store must describe the current setup of the
+        seismosizers. The store is closed and dropped, as soon as a command
+        changing the misfits is sent (see _command_sent()). Pass None to
+        close the current store.'''
+
+        if self.misfit_store is not None:
+            self.misfit_store.close()
+
+        self.misfit_store = store
+
     def set_database(self, gfdb, **kwargs):
         self.database = gfdb
         self.do_set_database( gfdb.path, **kwargs )
@@ -406,14 +1672,17 @@ class Seismosizer(SeismosizerBase):
 
     def set_receivers(self, receivers, **kwargs ):
         self.receivers = receivers
+        self._answer_maps = None
+        self._receiver_commands = [ {} for r in receivers ]
+        self._imbalanced = False
 
         receiverfn = pjoin(self.tempdir, "receivers")
         file = open(receiverfn, "w")
         for r in receivers:
             file.write( "%s\n" % str(r) )
         file.close()
+        # the file is kept, it is needed when the journal is replayed
         self.do_set_receivers(receiverfn, 'has_depth')
-        os.remove(receiverfn)
         self._locations_changed()
 
     def blacklist_receivers(self, blacklist):
@@ -452,6 +1721,7 @@ class Seismosizer(SeismosizerBase):
         args = (onoff,)
         self.do_switch_receiver( irec, *args, **kwargs)
         self.receivers[irec-1].enabled = onoff == 'on'
+        self._answer_maps = None
 
     def set_source( self, source, **kwargs ):
         self.source = source
@@ -465,6 +1735,7 @@ class Seismosizer(SeismosizerBase):
         if isinstance(taper, phase.Taper):
             taper = [ taper ] * len(self.receivers)
 
+        cmds = {}
         for irec, rec in enumerate(self.receivers):
             if taper[irec] is not None:
                 #if rec.depth != 0.0:
@@ -479,19 +1750,26 @@ class Seismosizer(SeismosizerBase):
                 # Phase(s) not existant at this distance
                 self.switch_receiver(irec+1, 'off')
             else:
-                self.do_set_misfit_taper( irec+1, *values )
+                cmds[irec] = ('set_misfit_taper', irec+1) + tuple(values)
+
+        self._set_receiver_commands(cmds)
 
     def set_filter( self, filter):
         self.filter = filter
         self.do_set_misfit_filter( *self.filter() )
+        for rec_cmds in self._receiver_commands:
+            rec_cmds.pop('set_misfit_filter_1', None)
 
     def set_filters(self, filters):
+        cmds = {}
         for irec, rec in enumerate(self.receivers):
             filter = filters[irec]
             if filter is not None:
-                self.do_set_misfit_filter_1( irec+1, *filter() )
+                cmds[irec] = ('set_misfit_filter_1', irec+1) + tuple(filter())
             else:
-                self.do_set_misfit_filter_1( irec+1 )
+                cmds[irec] = ('set_misfit_filter_1', irec+1)
+
+        self._set_receiver_commands(cmds)
 
     def set_misfit_method( self, method ):
         self.inner_misfit_method = method
@@ -504,26 +1782,55 @@ class Seismosizer(SeismosizerBase):
 
         if irec_range is None:
             irec_range = range(1,len(self.receivers)+1)
-        shifts = []
-        for irec in irec_range:
+
+        # each receiver is autoshifted on one process, all processes work
+        # concurrently; receivers held by all processes are spread over them
+        iprocs = []
+        cmds_by_proc = [ [] for p in self.processes ]
+        for i, irec in enumerate(irec_range):
             iproc = self.receivers[irec-1].proc_id
-            shift = float(self.do_autoshift_ref_seismogram(irec, shift_range[0], shift_range[1], where=iproc, **kwargs)[0])
+            if iproc is None:
+                iproc = i % len(self)
+
+            iprocs.append(iproc)
+            cmds_by_proc[iproc].append(('autoshift_ref_seismogram', irec, shift_range[0], shift_range[1]))
+
+        futures = [ (iproc, self.do_batch_async(cmds, where=iproc))
+                    for (iproc, cmds) in enumerate(cmds_by_proc) if cmds ]
+
+        answers_by_proc = [ [] for p in self.processes ]
+        errors = {}
+        for iproc, future in futures:
+            answers_by_proc[iproc] = future.result()[0]
+            for answer in answers_by_proc[iproc]:
+                if is_error(answer):
+                    errors[self.processes[iproc].tid] = answer.args[1]
+
+        if errors:
+            raise SeismosizersReturnedErrors(errors)
+
+        # shift reference seismograms in the other seismosizer processes
+        shifts = []
+        ipos = [ 0 ] * len(self)
+        shift_cmds_by_proc = [ [] for p in self.processes ]
+        for irec, iproc in zip(irec_range, iprocs):
+            shift = float(answers_by_proc[iproc][ipos[iproc]])
+            ipos[iproc] += 1
             shifts.append(shift)
-            if len(self)>1:
-                # shift reference seismograms in other seismosizer processes
-                others = range(len(self))
-                others.pop(iproc)
-                self.do_shift_ref_seismogram(irec, shift, where=others, **kwargs)
+            for iother in xrange(len(self)):
+                if iother != iproc:
+                    shift_cmds_by_proc[iother].append(('shift_ref_seismogram', irec, shift))
 
             self.receivers[irec-1].cumulative_shift += shift
 
+        self._do_per_process_batches(shift_cmds_by_proc)
 
         return shifts
 
     def set_synthetic_reference(self):
         """Calculate seismograms and use these as reference"""
         tempfnbase = self.tempdir + "/syntref"
-        self.do_output_seismograms(tempfnbase, "mseed", "synthetics", "plain")
+        self.output_seismograms(tempfnbase, "mseed", "synthetics", "plain")
         self.do_set_ref_seismograms(tempfnbase, "mseed")
 
     def shift_ref_seismograms( self, shifts, irec_range=None, **kwargs):
@@ -534,8 +1841,9 @@ class Seismosizer(SeismosizerBase):
         if irec_range is None:
             irec_range = range(1,len(self.receivers)+1)
 
+        cmds = [ ('shift_ref_seismogram', irec, shift) for (irec, shift) in zip(irec_range, shifts) ]
+        self._do_per_process_batches([ cmds ] * len(self))
         for irec, shift in zip(irec_range, shifts):
-            self.do_shift_ref_seismogram(irec, shift, **kwargs)
             self.receivers[irec-1].cumulative_shift += shift
 
     def get_receivers_snapshot( self,
@@ -555,10 +1863,10 @@ class Seismosizer(SeismosizerBase):
         tempfnbase4 = pjoin(tdir, "syn_spectrum")
 
         extension = 'table'
-        if 'ref' in which_seismograms: self.do_output_seismograms(tempfnbase1, extension, "references", which_processing)
-        if 'syn' in which_seismograms: self.do_output_seismograms(tempfnbase2, extension, "synthetics", which_processing)
-        if 'ref' in which_spectra: self.do_output_seismogram_spectra(tempfnbase3, "references", which_processing)
-        if 'syn' in which_spectra: self.do_output_seismogram_spectra(tempfnbase4, "synthetics", which_processing)
+        if 'ref' in which_seismograms: self.output_seismograms(tempfnbase1, extension, "references", which_processing)
+        if 'syn' in which_seismograms: self.output_seismograms(tempfnbase2, extension, "synthetics", which_processing)
+        if 'ref' in which_spectra: self.output_seismogram_spectra(tempfnbase3, "references", which_processing)
+        if 'syn' in which_spectra: self.output_seismogram_spectra(tempfnbase4, "synthetics", which_processing)
 
         receivers = copy.deepcopy(self.receivers)
         for irec, rec in enumerate(receivers):
@@ -645,12 +1953,12 @@ class Seismosizer(SeismosizerBase):
 
     def make_floating_shifts(self, source):
         self.make_misfits_for_source(source)
-        results = self.do_get_floating_shifts()
-        values = [[ float(x) for x in result.split() ] for result in results ]
+        results = self.do_get_floating_shifts(where=self._query_where())
+        values = [ answer_values(result) for result in results ]
         ipos = [ 0 ] * len(results)
         for irec, rec in enumerate(self.receivers):
             if rec.enabled:
-                iproc = rec.proc_id
+                iproc = self._answer_index(rec)
                 rec.floating_shift = values[iproc][ipos[iproc]]
                 ipos[iproc] += 1
             else:
@@ -658,30 +1966,240 @@ class Seismosizer(SeismosizerBase):
 
     def _gather_misfits_into_receivers(self, results):
 
-        values = [[ float(x) for x in result.split() ] for result in results ]
-        ipos = [ 0 ] * len(results)
+        ncomponents, maps = self._get_answer_maps()
+        misfits = num.zeros((len(self.receivers), ncomponents), dtype=num.float)
+        norms = num.zeros((len(self.receivers), ncomponents), dtype=num.float)
+        for slots, result in zip(maps, results):
+            values = answer_values(result)
+            assert values.size == 2*slots.size, "if this is printed, there is a bug in make_misifits_for_source()"
+            misfits.flat[slots] = values[0::2]
+            norms.flat[slots] = values[1::2]
+
         for irec, rec in enumerate(self.receivers):
             if rec.enabled:
-                iproc = rec.proc_id
-                for icomp in xrange(len(rec.components)):
-                    rec.misfits[icomp] = values[iproc][ipos[iproc]]
-                    ipos[iproc] += 1
-                    rec.misfit_norm_factors[icomp] = values[iproc][ipos[iproc]]
-                    ipos[iproc] += 1
-
-        for iproc in range(len(results)):
-            assert ipos[iproc] == len(values[iproc]), "if this is printed, there is a bug in make_misifits_for_source()"
+                ncomps = len(rec.components)
+                rec.misfits[:] = misfits[irec,:ncomps].tolist()
+                rec.misfit_norm_factors[:] = norms[irec,:ncomps].tolist()
 
     def make_misfits_for_source( self, source ):
         """Calculate misfits for given source and fill these into the receivers datastructure."""
 
         self.set_source(source)
-        results = self.do_get_misfits()
+        results = self.do_get_misfits(where=self._query_where())
         self._gather_misfits_into_receivers(results)
 
-    def make_misfits_for_sources(self, sources, show_progress=False, progress_title='grid search'):
-        '''Get misfits for many sources gathered by (source,receiver,component).'''
+    def make_misfits_for_sources(self, sources, show_progress=False, progress_title='grid search',
+                                 prune_margin=None, prune_stages=4, prune_probes=8, prune_bound=None,
+                                 **outer_misfit_config):
+        '''Get misfits for many sources gathered by (source,receiver,component).
+
+        sources may be a list of sources or a source.SourceGrid.
+
+        Results for sources found in the misfit cache or in the misfit store
+        are not recomputed. Unlike make_misfits_for_source(), this does not
+        update the misfits stored in the receivers.
+
+        If prune_margin is given, sources which are clearly worse than the
+        best ones are not computed completely, see _make_misfits_pruned().
+        Their misfits and norms are set to NaN. A PruneBound given as
+        prune_bound is used and updated, to carry the bound over to the
+        next call.'''
+
+        if prune_margin is not None:
+            return self._make_misfits_pruned(sources, show_progress, progress_title,
+                                             prune_margin, prune_stages, prune_probes, prune_bound,
+                                             outer_misfit_config)
+
+        return self._make_misfits_cached(sources, show_progress, progress_title)
+
+    def _make_misfits_cached(self, sources, show_progress=False, progress_title='grid search'):
+        cache = self.misfit_cache
+        store = self.misfit_store
+        if cache.size <= 0 and store is None:
+            return self._compute_misfits_for_sources(sources, show_progress, progress_title)
+
+        nsources = len(sources)
+        nreceivers = len(self.receivers)
+        ncomponents = max([ len(r.components) for r in self.receivers ])
+        misfits_by_src = num.zeros( (nsources, nreceivers, ncomponents), dtype=num.float)
+        norms_by_src = num.zeros(  (nsources, nreceivers, ncomponents), dtype=num.float)
 
+        enabled = tuple([ rec.enabled for rec in self.receivers ])
+        keys = [ (enabled, str(source)) for source in sources ]
+        failings = []
+        todo = []
+        for isource, key in enumerate(keys):
+            cached = None
+            if cache.size > 0:
+                cached = cache.get(key)
+
+            if cached is None and store is not None:
+                cached = store.get(key)
+                if cached is not None:
+                    cache.put(key, *cached)
+
+            if cached is None:
+                todo.append(isource)
+            elif cached[0] is None:
+                failings.append(isource)
+            else:
+                misfits_by_src[isource], norms_by_src[isource] = cached
+
+        if todo:
+            misfits_todo, norms_todo, failings_todo = self._compute_misfits_for_sources(
+                source_model.take_sources(sources, todo), show_progress, progress_title)
+
+            misfits_by_src[todo] = misfits_todo
+            norms_by_src[todo] = norms_todo
+            failings_todo = set(failings_todo)
+            for i, isource in enumerate(todo):
+                if i in failings_todo:
+                    failings.append(isource)
+                    entry = None, None
+                else:
+                    entry = misfits_todo[i].copy(), norms_todo[i].copy()
+
+                cache.put(keys[isource], *entry)
+                if store is not None:
+                    store.put(keys[isource], *entry)
+
+            if store is not None:
+                store.flush()
+
+            failings.sort()
+
+        return misfits_by_src, norms_by_src, failings
+
+    def _make_misfits_pruned(self, sources, show_progress, progress_title,
+                             prune_margin, prune_stages, prune_probes, prune_bound, outer_misfit_config):
+        '''Branch and bound variant of make_misfits_for_sources().
+
+        The enabled receivers are split into prune_stages interleaved
+        groups, which are computed one after the other. After the first
+        group, the prune_probes most promising sources are completed, to
+        get the best global misfit and an estimate of the norm of each
+        receiver. Before each further group, sources whose global misfit
+        must exceed the best one by more than the factor (1+prune_margin)
+        are dropped. Their misfits can only grow with the receivers still
+        missing, while their norms are bounded by the norms estimated from
+        the probes.
+
+        If prune_bound already knows a best misfit, no probes are computed
+        and its best misfit and norm estimates are used instead. The sources
+        completed here are added to it.'''
+
+        enabled = num.array([ rec.enabled for rec in self.receivers ], dtype=num.bool)
+        ienabled = num.nonzero(enabled)[0]
+        nstages = min(prune_stages, ienabled.size)
+        nsources = len(sources)
+        known = prune_bound is not None and prune_bound.known()
+        if nstages < 2 or (nsources <= prune_probes and not known):
+            return self._make_misfits_cached(sources, show_progress, progress_title)
+
+        stages = [ ienabled[istage::nstages] for istage in xrange(nstages) ]
+
+        nreceivers = len(self.receivers)
+        ncomponents = max([ len(r.components) for r in self.receivers ])
+        misfits_by_src = num.zeros( (nsources, nreceivers, ncomponents), dtype=num.float)
+        norms_by_src = num.zeros(  (nsources, nreceivers, ncomponents), dtype=num.float)
+        failing = num.zeros(nsources, dtype=num.bool)
+
+        outer_norm = outer_misfit_config.get('outer_norm', 'l2norm')
+        anarchy = outer_misfit_config.get('anarchy', False)
+        tweights = num.ones(nreceivers, dtype=num.float) * outer_misfit_config.get('receiver_weights', 1.)
+        if outer_norm == 'l2norm':
+            tweights = tweights**2
+
+        def compute(isources, istages, title):
+            mask = num.zeros(nreceivers, dtype=num.bool)
+            for istage in istages:
+                mask[stages[istage]] = True
+
+            self._set_enabled_receivers(mask)
+            misfits, norms, failings = self._make_misfits_cached(
+                source_model.take_sources(sources, isources), show_progress, title)
+
+            # disabled receivers have zero misfits and norms
+            misfits_by_src[isources] += misfits
+            norms_by_src[isources] += norms
+            failing[isources[failings]] = True
+
+        # balance method 'auto' must not judge from a single stage
+        self._balance_suspended = True
+        try:
+            alive = num.arange(nsources)
+            compute(alive, [0], '%s (stage 1/%i)' % (progress_title, nstages))
+
+            mterms, nterms = make_misfit_terms(misfits_by_src, norms_by_src, outer_norm, anarchy)
+            partial = misfits_from_terms(mterms, nterms, tweights[num.newaxis,:], outer_norm)[:,0]
+            partial[failing] = num.NaN
+            ok = num.nonzero(num.isfinite(partial))[0]
+            if ok.size == 0:
+                misfits_by_src[:] = 0.
+                norms_by_src[:] = 0.
+                return misfits_by_src, norms_by_src, range(nsources)
+
+            if known:
+                probes = num.zeros(0, dtype=num.int)
+                best, norms_estimate = prune_bound.best, prune_bound.norms
+            else:
+                probes = ok[num.argsort(partial[ok])[:prune_probes]]
+                compute(probes, range(1, nstages), '%s (probes)' % progress_title)
+
+                mterms, nterms = make_misfit_terms(misfits_by_src[probes], norms_by_src[probes], outer_norm, anarchy)
+                best = num.nanmin(misfits_from_terms(mterms, nterms, tweights[num.newaxis,:], outer_norm))
+                norms_estimate = num.max(nterms, 0)
+
+            isprobe = num.zeros(nsources, dtype=num.bool)
+            isprobe[probes] = True
+            alive = num.nonzero(num.logical_not(num.logical_or(isprobe, failing)))[0]
+            pruned = []
+            for istage in xrange(1, nstages):
+                if num.isfinite(best):
+                    mterms, nterms = make_misfit_terms(misfits_by_src[alive], norms_by_src[alive], outer_norm, anarchy)
+                    for jstage in xrange(istage, nstages):
+                        nterms[:,stages[jstage]] = norms_estimate[stages[jstage]]
+
+                    bound = misfits_from_terms(mterms, nterms, tweights[num.newaxis,:], outer_norm)[:,0]
+                    hopeless = bound > best * (1.+prune_margin)
+                    pruned.extend(alive[hopeless])
+                    alive = alive[num.logical_not(hopeless)]
+
+                compute(alive, [istage], '%s (stage %i/%i)' % (progress_title, istage+1, nstages))
+                alive = alive[num.logical_not(failing[alive])]
+
+        finally:
+            self._set_enabled_receivers(enabled)
+            self._balance_suspended = False
+
+        if prune_bound is not None:
+            complete = num.concatenate((probes[num.logical_not(failing[probes])], alive))
+            mterms, nterms = make_misfit_terms(misfits_by_src[complete], norms_by_src[complete], outer_norm, anarchy)
+            prune_bound.update(misfits_from_terms(mterms, nterms, tweights[num.newaxis,:], outer_norm)[:,0], nterms)
+
+        # partial results of sources failing in a later stage
+        misfits_by_src[failing] = 0.
+        norms_by_src[failing] = 0.
+
+        misfits_by_src[pruned] = num.NaN
+        norms_by_src[pruned] = num.NaN
+        logger.info('Pruned %i of %i sources' % (len(pruned), nsources))
+
+        return misfits_by_src, norms_by_src, list(num.nonzero(failing)[0])
+
+    def _set_enabled_receivers(self, mask):
+        for rec, onoff in zip(self.receivers, mask):
+            rec.enabled = bool(onoff)
+
+        self._answer_maps = None
+        gather([ self.do_async(('switch_receivers', self._receiver_states(iproc)), where=iproc)
+                 for iproc in xrange(len(self)) ])
+
+        # the cost equations of a window assume a fixed set of enabled receivers
+        if self.active_balance_method == 'adaptive':
+            self._start_adaptive_window()
+
+    def _compute_misfits_for_sources(self, sources, show_progress=False, progress_title='grid search'):
         nsources = len(sources)
         nreceivers = len(self.receivers)
         ncomponents = max([ len(r.components) for r in self.receivers ])
@@ -690,6 +2208,10 @@ class Seismosizer(SeismosizerBase):
         misfits_by_src = num.zeros( (nsources, nreceivers, ncomponents), dtype=num.float)
         norms_by_src = num.zeros(  (nsources, nreceivers, ncomponents), dtype=num.float)
 
+        # views, indexed by source and answer slot (see _get_answer_maps())
+        misfits_flat = misfits_by_src.reshape((nsources, nreceivers*ncomponents))
+        norms_flat = norms_by_src.reshape((nsources, nreceivers*ncomponents))
+
         if nsources == 0: show_progress=False
 
         if show_progress:
@@ -699,32 +2221,139 @@ class Seismosizer(SeismosizerBase):
 
             pbar = progressbar.ProgressBar(widgets=widgets, maxval=len(sources)).start()
 
+        if self._sharded_by_sources():
+            blocks = self._misfit_blocks_by_source_sharding(sources)
+        else:
+            blocks = self._misfit_blocks_by_receiver_sharding(sources)
+
         failings = []
-        for isource, source in enumerate(sources):
-            try:
-                self.set_source(source)
-                results = self.do_get_misfits()
+        ndone = 0
+        for ibegin, block, answers in blocks:
+            isources = []
+            rows = [ [] for answer in answers ]
+            for iblock in xrange(len(block)):
+                isource = ibegin + iblock
+                failed = False
+                for answer in answers:
+                    failed |= is_error(answer[iblock*2]) or is_error(answer[iblock*2+1])
+
+                if failed:
+                    failings.append(isource)
+                    continue
+
+                isources.append(isource)
+                for ianswer, answer in enumerate(answers):
+                    rows[ianswer].append(answer_values(answer[iblock*2+1]))
+
+            if isources:
+                # receivers may have been moved since the last block
+                maps = self._get_answer_maps()[1]
+                isources = num.array(isources)[:,num.newaxis]
+                for slots, answer_rows in zip(maps, rows):
+                    values = num.array(answer_rows)
+                    assert values.shape[1] == 2*slots.size, "if this is printed, there is a bug in make_misfits_for_sources()"
+                    misfits_flat[isources, slots] = values[:,0::2]
+                    norms_flat[isources, slots] = values[:,1::2]
+
+            ndone += len(block)
+            if show_progress: pbar.update(ndone)
+
+        if self.balance_method == 'auto' and self.receivers is not None and not self._balance_suspended:
+            method = self._choose_balance_method()
+            if method != self.active_balance_method:
+                logger.info('Switching balance method from %s to %s' % (self.active_balance_method, method))
+                self.balance(method)
 
-                self._gather_misfits_into_receivers(results)
-                for ireceiver, receiver in enumerate(self.receivers):
-                    if receiver.enabled:
-                        for icomp, comp in enumerate(receiver.components):
-                            misfits_by_src[isource, ireceiver, icomp] = receiver.misfits[icomp]
-                            norms_by_src[isource, ireceiver, icomp] = receiver.misfit_norm_factors[icomp]
+        if show_progress: pbar.finish()
 
-            except SeismosizersReturnedErrors:
-                failings.append(isource)
+        return misfits_by_src, norms_by_src, failings
 
-            if show_progress: pbar.update(isource+1)
+    def _misfit_commands(self, block):
+        cmds = []
+        for source in block:
+            cmds.append(('set_source_params', source))
+            cmds.append(('get_misfits',))
+        return cmds
 
-        if show_progress: pbar.finish()
+    def _misfit_blocks_by_receiver_sharding(self, sources):
+        '''Let all processes work on each block of sources.
 
-        return misfits_by_src, norms_by_src, failings
+        The next block is sent before the answers of the current one are
+        yielded, so that parsing overlaps with the computation.'''
 
-    def make_global_misfits_for_sources(self, sources, **outer_misfit_config):
+        def submit(ibegin):
+            block = sources[ibegin:ibegin+self.batch_size]
+            return ibegin, block, self.do_batch_async(self._misfit_commands(block))
+
+        pending = None
+        for ibegin in xrange(0, len(sources), self.batch_size):
+            if self._adaptive_rebalance_due():
+                # receivers may only be moved when no block is in flight
+                if pending is not None:
+                    yield self._finish_block(*pending)
+                    pending = None
+
+                self._rebalance_adaptive()
+
+            current = submit(ibegin)
+            if pending is not None:
+                yield self._finish_block(*pending)
+
+            pending = current
+
+        if pending is not None:
+            yield self._finish_block(*pending)
+
+    def _finish_block(self, ibegin, block, future):
+        answers = future.result()
+        self.source = block[-1]
+        durations = future.durations.values()
+        if len(self) > 1 and len(durations) == len(self) and not self._balance_suspended:
+            self.source_costs[0] += max(durations)
+            self.source_costs[1] += sum(durations)/len(durations)
+            self.source_costs_count += len(block)
+
+        self._window_nsources += len(block)
+        return ibegin, block, answers
+
+    def _misfit_blocks_by_source_sharding(self, sources):
+        '''Dispatch blocks of sources to whichever process is free.
+
+        Blocks are yielded in the order they complete.'''
+
+        completed = Queue()
+        pending = {}
+        ibegins = iter(xrange(0, len(sources), self.batch_size))
+
+        def submit(iproc):
+            try:
+                ibegin = ibegins.next()
+            except StopIteration:
+                return
+
+            block = sources[ibegin:ibegin+self.batch_size]
+            future = self.do_batch_async(self._misfit_commands(block), where=iproc)
+            pending[future] = iproc, ibegin, block
+            future.add_done_callback(completed.put)
+
+        for iproc in xrange(len(self)):
+            submit(iproc)
+
+        while pending:
+            future = completed.get()
+            iproc, ibegin, block = pending.pop(future)
+            answers = future.result()
+            submit(iproc)
+            yield ibegin, block, answers
+
+        # the processes have been left with different sources
+        self.source = None
+
+    def make_global_misfits_for_sources(self, sources, prune_margin=None, **outer_misfit_config):
         receiver_mask = num.array([ rec.enabled for rec in self.receivers ], dtype=num.bool)
 
-        misfits_by_src, norms_by_src, failings = self.make_misfits_for_sources(sources)
+        misfits_by_src, norms_by_src, failings = self.make_misfits_for_sources(sources,
+                prune_margin=prune_margin, **outer_misfit_config)
         misfits_by_s, misfits_by_sr = make_global_misfits( misfits_by_src, norms_by_src,
             reveiver_mask=receiver_mask, **outer_misfit_config)
 
@@ -744,14 +2373,14 @@ class Seismosizer(SeismosizerBase):
         """Calculate peak amplitudes at receivers for given source."""
 
         self.set_source(source)
-        results = self.do_get_peak_amplitudes(ndiff)
-        values = [[ float(x) for x in result.split() ] for result in results ]
+        results = self.do_get_peak_amplitudes(ndiff, where=self._query_where())
+        values = [ answer_values(result) for result in results ]
 
         maxabs = [ 0.0 ] * len(self.receivers)
 
         ipos = [ 0 ] * len(results)
         for irec, rec in enumerate(self.receivers):
-            iproc = rec.proc_id
+            iproc = self._answer_index(rec)
             maxabs[irec] = values[iproc][ipos[iproc]]
             ipos[iproc] += 1
 
@@ -761,14 +2390,14 @@ class Seismosizer(SeismosizerBase):
         """Calculate peak amplitudes at receivers for given source."""
 
         self.set_source(source)
-        results = self.do_get_arias_intensities()
-        values = [[ float(x) for x in result.split() ] for result in results ]
+        results = self.do_get_arias_intensities(where=self._query_where())
+        values = [ answer_values(result) for result in results ]
 
         intensities = [ 0.0 ] * len(self.receivers)
 
         ipos = [ 0 ] * len(results)
         for irec, rec in enumerate(self.receivers):
-            iproc = rec.proc_id
+            iproc = self._answer_index(rec)
 
             intensities[irec] = values[iproc][ipos[iproc]]
             ipos[iproc] += 1
@@ -784,9 +2413,36 @@ class Seismosizer(SeismosizerBase):
 
     def balance(self, method='123321'):
 
-        if method == 'serial':
-            for irec in range(len(self.receivers)):
-                self._set_receiver_process(irec+1, None)
+        self._answer_maps = None
+
+        if method == 'auto':
+            method = self._choose_balance_method()
+
+        if (method in self.source_sharded_methods) != self._sharded_by_sources():
+            # costs measured with the other sharding say nothing about this one
+            self.source_costs = [0., 0.]
+            self.source_costs_count = 0
+
+        if method == 'adaptive':
+            # the static layout is only the starting point; later calls
+            # refine the assignment learned so far
+            if self._receiver_costs_for is not self.receivers:
+                self._init_receiver_costs()
+                self.balance('123321')
+            elif None in [ rec.proc_id for rec in self.receivers ]:
+                self.balance('123321')
+            elif len(self) > 1:
+                self._reassign_by_costs()
+
+            self.active_balance_method = 'adaptive'
+            self._start_adaptive_window()
+            return
+
+        self.active_balance_method = method
+
+        proc_ids = [ None ] * len(self.receivers)
+        if method in self.source_sharded_methods:
+            pass
 
         else:
 
@@ -801,7 +2457,7 @@ class Seismosizer(SeismosizerBase):
                 dist_delta = (dist_range[1]-dist_range[0])/len(self)
                 if method == '123123':
                     for idist, irec in enumerate(num.argsort(distances)):
-                        self._set_receiver_process(irec+1, idist % len(self))
+                        proc_ids[irec] = idist % len(self)
 
                 else:
                     for irec, dist in enumerate( distances ):
@@ -813,18 +2469,299 @@ class Seismosizer(SeismosizerBase):
                         elif method == '112233':
                             iproc = max(min(int((dist-dist_range[0])/dist_delta),len(self)-1),0)
 
-                        self._set_receiver_process(irec+1, iproc)
+                        proc_ids[irec] = iproc
 
             else:
-                for irec in range(len(self.receivers)):
-                    self._set_receiver_process(irec+1, 0)
+                proc_ids = [ 0 ] * len(self.receivers)
+
+        self._assign_receivers(proc_ids)
+
+    def _init_receiver_costs(self):
+        # initial guess: cost is proportional to number of components
+        self.receiver_costs = num.array([ float(len(rec.components)) for rec in self.receivers ], dtype=num.float)
+        self._receiver_costs_for = self.receivers
+        self._cost_observations = []
+
+    def _start_adaptive_window(self):
+        self._window_busy_times = self.busy_times.copy()
+        self._window_nsources = 0
+
+    def _adaptive_rebalance_due(self):
+        return self.active_balance_method == 'adaptive' and len(self) > 1 and \
+            self._window_nsources >= self.rebalance_interval
+
+    def _rebalance_adaptive(self):
+        '''Update the receiver cost estimates and reassign the receivers.
+
+        Each rebalancing window gives one equation per process: its busy
+        time per source is a constant overhead plus the sum of the costs of
+        its enabled receivers. As receivers move between processes, the
+        equations of the last cost_memory windows determine the individual
+        costs, which are solved for by least squares, regularized towards
+        the previous estimate.'''
+
+        nprocs = len(self)
+        nreceivers = len(self.receivers)
+        times = (self.busy_times - self._window_busy_times) / self._window_nsources
+
+        rows = num.zeros((nprocs, nreceivers+1), dtype=num.float)
+        rows[:,-1] = 1.
+        for irec, rec in enumerate(self.receivers):
+            if rec.enabled:
+                rows[rec.proc_id, irec] = 1.
+
+        self._cost_observations.append((rows, times))
+        del self._cost_observations[:-self.cost_memory]
+
+        a = num.vstack([ x[0] for x in self._cost_observations ])
+        t = num.concatenate([ x[1] for x in self._cost_observations ])
+
+        prior = num.zeros(nreceivers+1, dtype=num.float)
+        prior[:-1] = self.receiver_costs
+        if len(self._cost_observations) == 1:
+            # initial guess has arbitrary units
+            prior *= num.sum(t) / num.sum(num.dot(a, prior))
+
+        reg = self.cost_regularization * num.identity(nreceivers+1)
+        x = num.linalg.lstsq(num.vstack((a, reg)),
+                             num.concatenate((t, num.dot(reg, prior))), rcond=-1)[0]
+
+        self.receiver_costs = num.maximum(x[:-1], 0.)
+        self._reassign_by_costs()
+        self._start_adaptive_window()
+
+    def _reassign_by_costs(self):
+        '''Move receivers between the most and the least loaded process.
+
+        In each step, either a single receiver is moved from the most to the
+        least loaded process, or two receivers are swapped between them,
+        whichever brings their loads closest together; this is repeated for
+        as long as it reduces the spread of the loads. The new assignment
+        is only applied when it reduces the predicted time of the slowest
+        process by more than rebalance_tolerance, so that receivers stay
+        where their Green's functions are cached.'''
+
+        nprocs = len(self)
+        costs = self.receiver_costs
+        enabled = num.array([ rec.enabled for rec in self.receivers ], dtype=num.bool)
+        procs = num.array([ rec.proc_id for rec in self.receivers ], dtype=num.int)
+        loads = num.zeros(nprocs, dtype=num.float)
+        for iproc in xrange(nprocs):
+            loads[iproc] = num.sum(costs[num.logical_and(enabled, procs == iproc)])
+
+        makespan = num.max(loads)
+        for i in xrange(len(self.receivers)):
+            imax, imin = num.argmax(loads), num.argmin(loads)
+            gap = loads[imax] - loads[imin]
+            on_max = num.where(num.logical_and(enabled, procs == imax))[0]
+            on_min = num.where(num.logical_and(enabled, procs == imin))[0]
+
+            # last column: move without swapping
+            delta = costs[on_max][:,num.newaxis] - num.append(costs[on_min], 0.)[num.newaxis,:]
+            badness = num.where(num.logical_and(0. < delta, delta < gap), num.abs(delta-gap/2.), num.inf)
+            if on_max.size == 0 or not num.isfinite(num.min(badness)):
+                break
+
+            jmax, jmin = num.unravel_index(num.argmin(badness), badness.shape)
+            procs[on_max[jmax]] = imin
+            if jmin < on_min.size:
+                procs[on_min[jmin]] = imax
+
+            loads[imax] -= delta[jmax,jmin]
+            loads[imin] += delta[jmax,jmin]
+
+        if num.max(loads) >= (1.-self.rebalance_tolerance)*makespan:
+            return
+
+        logger.info('Rebalancing receivers, predicted speedup: %g' % (makespan/num.max(loads)))
+        self._assign_receivers([ int(iproc) for iproc in procs ])
+
+    def _choose_balance_method(self):
+        '''Choose between receiver and source sharding for balance method 'auto'.
+
+        Sources are sharded when there are too few enabled receivers to keep
+        all processes busy, or when the measured per-source times of the
+        processes are so unequal, that the slowest process dominates.
+
+        The receiver count is checked on every call. A decision based on
+        the costs is kept until the receivers are set anew.'''
+
+        nprocs = len(self)
+        if nprocs == 1:
+            return '123321'
+
+        nenabled = len([ rec for rec in self.receivers if rec.enabled ])
+        if nenabled < self.min_receivers_per_process * nprocs:
+            return 'sources'
+
+        if self._imbalanced and self._sharded_by_sources():
+            return self.active_balance_method
+
+        self._imbalanced = False
+        if self.source_costs_count > 0:
+            slowest, mean = self.source_costs
+            if slowest > self.imbalance_limit * mean:
+                self._imbalanced = True
+                return 'sources'
+
+        return '123321'
+
+    def _sharded_by_sources(self):
+        return self.active_balance_method in self.source_sharded_methods
+
+    def _query_where(self):
+        '''Processes to be asked for per-receiver results.
+
+        If every process holds all receivers, only the first one is asked.'''
+
+        if self._sharded_by_sources():
+            return 0
+        return None
+
+    def _answer_index(self, rec):
+        '''Index of the answer containing the results of receiver rec.'''
+
+        if rec.proc_id is None:
+            return 0
+        return rec.proc_id
+
+    def _get_answer_maps(self):
+        '''Map positions in the per-receiver answers to (receiver, component) slots.
+
+        Returns ncomponents and, for each answer of a query to the
+        processes (see _query_where()), the array of slots
+        irec*ncomponents+icomp, in the order in which the values for
+        receivers and components come in. The maps are cached until
+        receivers are switched or moved between processes.'''
+
+        if self._answer_maps is None:
+            ncomponents = max([ len(r.components) for r in self.receivers ])
+            if self._query_where() is None:
+                nanswers = len(self)
+            else:
+                nanswers = 1
+
+            slots = [ [] for i in xrange(nanswers) ]
+            for irec, rec in enumerate(self.receivers):
+                if rec.enabled:
+                    iproc = self._answer_index(rec)
+                    for icomp in xrange(len(rec.components)):
+                        slots[iproc].append(irec*ncomponents+icomp)
+
+            self._answer_maps = ncomponents, [ num.array(s, dtype=num.int) for s in slots ]
+
+        return self._answer_maps
+
+    def _set_receiver_commands(self, cmds):
+        '''Send per-receiver setup commands to the processes owning the receivers.
+
+        cmds is a dict of commands, keyed by receiver index. The commands
+        for all receivers a process owns are sent to it in one request. They
+        are remembered, so that a process can get them when it takes over a
+        receiver (see _assign_receivers()). Commands which repeat the last
+        one remembered for a receiver are not sent again.'''
+
+        cmds_by_proc = [ [] for p in self.processes ]
+        sent = []
+        for irec in sorted(cmds.keys()):
+            cmd = cmds[irec]
+            if self._receiver_commands[irec].get(cmd[0]) == cmd:
+                self.nsuppressed += 1
+                continue
+
+            self._receiver_commands[irec][cmd[0]] = cmd
+            sent.append((irec, cmd[0]))
+            for iproc in self._receiver_owners(self.receivers[irec].proc_id):
+                cmds_by_proc[iproc].append(cmd)
+
+        try:
+            self._do_per_process_batches(cmds_by_proc)
+        except SeismosizersReturnedErrors:
+            # don't know which ones failed
+            for irec, command in sent:
+                del self._receiver_commands[irec][command]
+            raise
+
+    def _command_sent(self, cmd):
+        # setup commands for receivers taken over by a process do not
+        # change the misfits
+        if cmd[0] not in self.misfit_state_commands or self._reassigning:
+            return
+
+        if len(self.misfit_cache):
+            logger.debug('Misfit cache cleared by command %s' % cmd[0])
+            self.misfit_cache.clear()
+
+        if self.misfit_store is not None:
+            logger.info('Misfit store %s dropped by command %s' % (self.misfit_store.filename, cmd[0]))
+            self.set_misfit_store(None)
+
+    def _receiver_owners(self, proc_id):
+        if proc_id is None:
+            return range(len(self))
+        return [ proc_id ]
+
+    def _do_per_process_batches(self, cmds_by_proc):
+        '''Send its list of commands to each process and wait for the answers.'''
+
+        futures = []
+        for iproc, cmds in enumerate(cmds_by_proc):
+            for ibegin in xrange(0, len(cmds), self.setup_block_size):
+                block = cmds[ibegin:ibegin+self.setup_block_size]
+                futures.append((iproc, self.do_batch_async(block, where=iproc)))
+
+        errors = {}
+        for iproc, future in futures:
+            for answer in future.result()[0]:
+                if is_error(answer):
+                    errors[self.processes[iproc].tid] = answer.args[1]
+
+        if errors:
+            raise SeismosizersReturnedErrors(errors)
 
-    def _set_receiver_process(self, irec, iproc):
-        self.receivers[irec-1].proc_id = iproc
-        if len(self) > 1:
-            self.do_switch_receiver(irec, 'off')
-            if self.receivers[irec-1].enabled:
-                self.do_switch_receiver(irec, 'on', where=iproc)
+    def _assign_receivers(self, proc_ids):
+        '''Assign receivers to processes, proc_id None meaning all processes.
+
+        Each process gets, in one request, the setup commands of the
+        receivers it takes over (see _set_receiver_commands()) and its full
+        set of enabled receivers.'''
+
+        self._answer_maps = None
+        setup = [ [] for p in self.processes ]
+        for irec, rec in enumerate(self.receivers):
+            old_owners = self._receiver_owners(rec.proc_id)
+            rec.proc_id = proc_ids[irec]
+            cmds = self._receiver_commands[irec].values()
+            if cmds:
+                for iproc in self._receiver_owners(rec.proc_id):
+                    if iproc not in old_owners:
+                        setup[iproc].extend(cmds)
+
+        self._reassigning = True
+        try:
+            if len(self) == 1:
+                self._do_per_process_batches(setup)
+                return
+
+            futures = []
+            for iproc in xrange(len(self)):
+                switch = ('switch_receivers', self._receiver_states(iproc))
+                if setup[iproc]:
+                    setup[iproc].append(switch)
+                else:
+                    futures.append(self.do_async(switch, where=iproc))
+
+            self._do_per_process_batches(setup)
+        finally:
+            self._reassigning = False
+
+        gather(futures)
+
+    def _receiver_states(self, iproc):
+        '''Receivers to be enabled on a process, as a string of 0s and 1s.'''
+
+        return ''.join([ str(int(rec.enabled and iproc in self._receiver_owners(rec.proc_id)))
+                         for rec in self.receivers ])
 
     def _fill_distazi( self ):
         fn = self.tempdir + '/distances'
@@ -840,6 +2777,76 @@ class Seismosizer(SeismosizerBase):
         f.close()
         os.remove(fn)
 
+class MisfitBatcher:
+    '''Evaluate the misfit requests of concurrent searches in common batches.
+
+       Each of nclients threads asks for the global misfits of some sources
+       with misfits(). The requests are collected until every client which
+       has not yet called finished() is waiting, and are then sent to the
+       seismosizer as one batch. This keeps all processes busy, even when
+       each search only needs a few sources at a time.
+    '''
+
+    def __init__(self, seis, nclients, **outer_misfit_config):
+        self.seis = seis
+        self.outer_misfit_config = outer_misfit_config
+        self.nactive = nclients
+        self.nbatches = 0
+        self._pending = []
+        self._condition = threading.Condition()
+
+    def misfits(self, sources):
+        '''Get global misfits of sources, NaN for invalid ones.'''
+
+        slot = {}
+        self._condition.acquire()
+        try:
+            self._pending.append((sources, slot))
+            self._evaluate_if_complete()
+            while not slot:
+                self._condition.wait()
+        finally:
+            self._condition.release()
+
+        if 'error' in slot:
+            raise slot['error']
+
+        return slot['misfits']
+
+    def finished(self):
+        '''Tell that the calling client will not request any more misfits.'''
+
+        self._condition.acquire()
+        try:
+            self.nactive -= 1
+            self._evaluate_if_complete()
+        finally:
+            self._condition.release()
+
+    def _evaluate_if_complete(self):
+        if not self._pending or len(self._pending) < self.nactive:
+            return
+
+        pending, self._pending = self._pending, []
+        sources = []
+        for (s, slot) in pending:
+            sources.extend(s)
+
+        try:
+            misfits_by_s, failings = self.seis.make_global_misfits_for_sources(
+                                                    sources, **self.outer_misfit_config)
+            self.nbatches += 1
+            ibegin = 0
+            for (s, slot) in pending:
+                slot['misfits'] = misfits_by_s[ibegin:ibegin+len(s)]
+                ibegin += len(s)
+
+        except Exception, e:
+            for (s, slot) in pending:
+                slot['error'] = e
+
+        self._condition.notifyAll()
+
 def make_global_misfits(misfits_by_src, norms_by_src, receiver_mask=None, receiver_weights=1., outer_norm='l2norm', anarchy=False, bootstrap=False, **kwargs):
 
     nreceivers = misfits_by_src.shape[1]
@@ -863,16 +2870,7 @@ def make_global_misfits(misfits_by_src, norms_by_src, receiver_mask=None, receiv
             else:
                 mask = mask2
 
-        if mask is not None:
-            nenabled = sum(mask)
-            enabled = num.arange(nreceivers, dtype=num.int)[mask]
-            bweights = num.zeros(nreceivers, dtype=num.float)
-            _bweights = num.bincount(num.take(enabled, num.random.randint(0,nenabled,nenabled)))
-            bweights[:_bweights.size] = _bweights
-        else:
-            bweights = num.zeros(nreceivers, dtype=num.float)
-            _bweights = num.bincount(num.random.randint(0,nreceivers,nreceivers))
-            bweights[:_bweights.size] = bweights_x[:]
+        bweights = bootstrap_weights(1, nreceivers, mask)[0]
 
     if outer_norm == 'l1norm':
         misfits_by_sr = num.sum(misfits_by_src,2)
@@ -901,7 +2899,7 @@ def make_global_misfits(misfits_by_src, norms_by_src, receiver_mask=None, receiv
         norms_by_sr   = num.sqrt(num.sum(norms_by_src**2,2))
 
         if anarchy:
-            rweights /= num.where( norms_by_sr != 0., norms_by_sr, -1.)
+            rweights = rweights / num.where( norms_by_sr != 0., norms_by_sr, -1.)
             rweights = num.maximum(rweights, 0.)
 
         if bootstrap:
@@ -921,10 +2919,112 @@ def make_global_misfits(misfits_by_src, norms_by_src, receiver_mask=None, receiv
 
     return misfits_by_s, misfits_by_sr
 
+def make_global_misfits_for_weights(misfits_by_src, norms_by_src, receiver_weights, receiver_mask=None, outer_norm='l2norm', anarchy=False, **kwargs):
+    '''Like make_global_misfits(), but for a stack of receiver weightings.
+
+    receiver_weights is an array of shape (nweightings, nreceivers). The
+    reduction over components is done once for all weightings. Receivers
+    not selected by receiver_mask get zero weight. Returns the global
+    misfits as an array of shape (nweightings, nsources), NaN where
+    undefined.'''
+
+    weights = num.array(receiver_weights, dtype=num.float)
+    if weights.ndim != 2 or weights.shape[1] != misfits_by_src.shape[1]:
+        raise Exception('receiver_weights must have shape (nweightings, nreceivers)')
+
+    if receiver_mask is not None:
+        weights *= num.asarray(receiver_mask, dtype=num.bool)[num.newaxis,:]
+
+    mterms, nterms = make_misfit_terms(misfits_by_src, norms_by_src, outer_norm=outer_norm, anarchy=anarchy)
+    if outer_norm == 'l2norm':
+        weights **= 2
+
+    return misfits_from_terms(mterms, nterms, weights, outer_norm=outer_norm).T
+
+def bootstrap_weights(niter, nreceivers, mask=None):
+    '''Draw niter bootstrap resamplings of the receivers selected by mask.
+
+    Returns an array of shape (niter, nreceivers), holding how often each
+    receiver has been drawn in each iteration.'''
+
+    enabled = num.arange(nreceivers, dtype=num.int)
+    if mask is not None:
+        enabled = enabled[num.asarray(mask, dtype=num.bool)]
+
+    nenabled = enabled.size
+    bweights = num.zeros((niter, nreceivers), dtype=num.float)
+    if nenabled == 0:
+        return bweights
+
+    draws = num.take(enabled, num.random.randint(0, nenabled, (niter, nenabled)))
+    draws += num.arange(niter, dtype=num.int)[:,num.newaxis] * nreceivers
+    counts = num.bincount(draws.ravel())
+    bweights.flat[:counts.size] = counts
+    return bweights
+
+def make_misfit_terms(misfits_by_src, norms_by_src, outer_norm='l2norm', anarchy=False):
+    '''Reduce misfits and norms over components, for weighting by receiver.
+
+    Returns arrays (mterms, nterms) of shape (nsources, nreceivers), which
+    give the global misfits for a weighting of the receivers by a matrix
+    product, see misfits_from_terms(). With anarchy, each receiver is
+    normalized by its own norm, as in make_global_misfits().'''
+
+    if outer_norm == 'l1norm':
+        mterms = num.sum(misfits_by_src,2)
+        nterms = num.sum(norms_by_src,2)
+
+    elif outer_norm == 'l2norm':
+        mterms = num.sqrt(num.sum(misfits_by_src**2,2))
+        nterms = num.sqrt(num.sum(norms_by_src**2,2))
+
+    else:
+        raise Exception('unknown norm method: %s' % outer_norm)
+
+    if anarchy:
+        scale = num.where(nterms > 0., 1./num.where(nterms > 0., nterms, 1.), 0.)
+        mterms *= scale
+        nterms *= scale
+
+    if outer_norm == 'l2norm':
+        mterms **= 2
+        nterms **= 2
+
+    return mterms, nterms
+
+def misfits_from_terms(mterms, nterms, tweights, outer_norm='l2norm'):
+    '''Get global misfits for several weightings of the receivers.
+
+    tweights is an array of shape (nweightings, nreceivers) of the weights
+    applied to the terms returned by make_misfit_terms(); for l2norm, these
+    are the squared receiver weights. Returns the global misfits as an array
+    of shape (nsources, nweightings), NaN where undefined.'''
+
+    ms = num.dot(mterms, tweights.T)
+    ns = num.dot(nterms, tweights.T)
+    misfits = ms / num.where(ns > 0., ns, 1.)
+    if outer_norm == 'l2norm':
+        misfits = num.sqrt(misfits)
+
+    return num.where(ns > 0., misfits, num.NaN)
+
+def gen_output_method(command):
+    def func(self, *args, **kwargs):
+        if 'where' not in kwargs:
+            kwargs['where'] = self._query_where()
+        return self.do( (func.command,)+args, **kwargs )
+
+    func.command = command
+    return func
+
 for command in Seismosizer.plain_commands:
     method = gen_do_method(command)
     setattr( Seismosizer, command, method )
 
+for command in Seismosizer.output_commands:
+    method = gen_output_method(command)
+    setattr( Seismosizer, command, method )
+
 if __name__ == '__main__':
     s = Seismosizer(['localhost', 'localhost', 'localhost'])
     print s.do_set_effective_dt(0.5)
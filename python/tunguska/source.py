@@ -1,5 +1,4 @@
 
-import random
 import copy
 import re
 from subprocess import Popen, PIPE
@@ -8,6 +7,7 @@ import config
 from pyrocko import moment_tensor
 import math
 import numpy as num
+import sampling
 
 def d2u(s):
     if '_' in s: raise Exception('uuups, found underscore in param name where not expected: %s' % s)
@@ -130,40 +130,34 @@ class Source:
              grid_definition = [ ('depth', [1000.,2000.,5000.,6000.]) ]
         
         source_constraints: Function callback, which may be used to turn off
-            individual points of the grid. The function is called with the current 
-            source as argument and must return True or False in order to turn on or 
-            turn off the grid node in question.
+            individual points of the grid. The function is called with each
+            source and must return True or False, in order to turn on or 
+            turn off the grid node. A callback marked as vectorized (see 
+            vectorized()) is called once, with the SourceGrid of all nodes 
+            as argument, and must return an array of True or False values.
+            
+        Returns a SourceGrid.
            """
-        return self._make_source_grid( grid_definition, source_constraints=None )
-    
-    def _make_source_grid( self, sourceparams, irecurs=0, paramlist=None, sourceslist=None, source_constraints=None ):
         
-        if paramlist is None:
-            paramlist = [0.] * len(sourceparams)
+        if not grid_definition:
+            return SourceGrid(self.clone(), [], num.zeros((0,0), dtype=num.float))
+        
+        params = [ param for (param, gvalues) in grid_definition ]
+        gvalues = [ num.asarray(gvalues, dtype=num.float) for (param, gvalues) in grid_definition ]
+        
+        # same order as nested loops over the parameters, last one innermost
+        indices = num.indices([ v.size for v in gvalues ]).reshape(len(gvalues), -1)
+        values = num.zeros((indices.shape[1], len(gvalues)), dtype=num.float)
+        for iparam, v in enumerate(gvalues):
+            values[:,iparam] = v[indices[iparam]]
+        
+        sources = SourceGrid(self.clone(), params, values)
+        if source_constraints is not None:
+            sources = sources.take(num.nonzero(sources.mask(source_constraints))[0])
             
-        if sourceslist is None:
-            sourceslist = []
-        
-        if sourceparams:
-            key = sourceparams[ irecurs ][0]
-            gvalues = [ float(v) for v in sourceparams[ irecurs ][1] ]
-            for v in gvalues:
-                paramlist[irecurs] = v
-                if irecurs < len(sourceparams)-1:
-                    self._make_source_grid( sourceparams, irecurs+1, paramlist, sourceslist, source_constraints=source_constraints )
-                else:
-                    v = {}
-                    for i,elem in enumerate(sourceparams):
-                        v[elem[0]] = paramlist[i]
-                    
-                    s = copy.deepcopy(self)
-                    s.update(v)
-                    if source_constraints == None or source_constraints(s):
-                        sourceslist.append(s)
-        
-        return sourceslist
-        
-    def randomize( self, sourceparams, nsources ):
+        return sources
+        
+    def randomize( self, sourceparams, nsources, method='uniform', seed=None ):
         '''Make random sources based on this one.
                
         sourceparams: A list of tuples, each defining parameter name, minimum,
@@ -172,20 +166,23 @@ class Source:
                 [(parameter, minimum, maximum), ...]
                 
         nsources: Number of sources to create.
+        
+        method: How to sample the parameter ranges, one of the methods in
+            sampling.methods: 'uniform', 'lhs' (latin hypercube), or the
+            quasi-random sequences 'halton' and 'sobol', which cover the 
+            ranges more evenly.
+        
+        seed: Seed for the random methods.
+        
+        Returns a SourceGrid.
         '''
-        sourceslist = []
-        for isource in xrange(nsources):
-            v = {}
-            for iparam in xrange(len(sourceparams)):
-                key = sourceparams[ iparam ][0]
-                vmin, vmax = [float(x) for x in sourceparams[ iparam ][1:] ]
-                v[key] = random.uniform(vmin, vmax)
-            
-            s = copy.deepcopy(self)
-            s.update(v)
-            sourceslist.append(s)
-            
-        return sourceslist
+        
+        params = [ x[0] for x in sourceparams ]
+        vmins = num.array([ float(x[1]) for x in sourceparams ], dtype=num.float)
+        vmaxs = num.array([ float(x[2]) for x in sourceparams ], dtype=num.float)
+        
+        samples = sampling.sample(method, nsources, len(params), seed=seed)
+        return SourceGrid(self.clone(), params, vmins + samples*(vmaxs-vmins))
 
 
     def moment_tensor( self ):
@@ -206,6 +203,99 @@ class Source:
         
         return mt    
 
+class SourceGrid:
+    '''Set of sources, differing from a base source in a few parameters.
+    
+    Only the values of the varying parameters are stored, as an array of
+    shape (nsources, nparams). The object can be used almost like a list of
+    sources, which are created on access. Indexing with a slice or take()
+    gives a SourceGrid. Indexing with a parameter name gives the values of
+    that parameter for all sources.'''
+    
+    def __init__(self, base_source, params, values):
+        for param in params:
+            if param not in base_source.keys():
+                raise Exception('invalid source parameter: "%s" for source type: "%s"' % 
+                                (param, base_source.sourcetype()))
+                
+        self.base_source = base_source
+        self.params = list(params)
+        self.values = num.asarray(values, dtype=num.float)
+        
+    def __len__(self):
+        return self.values.shape[0]
+    
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self._source(i)
+            
+    def __getitem__(self, i):
+        if isinstance(i, str):
+            return self.get_values(i)
+        
+        if isinstance(i, slice):
+            return SourceGrid(self.base_source, self.params, self.values[i])
+        
+        return self._source(i)
+    
+    def take(self, indices):
+        '''Get SourceGrid of the sources at given indices.'''
+        
+        indices = num.asarray(indices, dtype=num.int)
+        return SourceGrid(self.base_source, self.params, num.take(self.values, indices, axis=0))
+    
+    def get_values(self, param):
+        '''Get values of a parameter for all sources.'''
+        
+        if param in self.params:
+            return self.values[:,self.params.index(param)].copy()
+        
+        return num.ones(len(self), dtype=num.float) * self.base_source[param]
+    
+    def mask(self, source_constraints):
+        '''Evaluate source_constraints callback, see Source.grid().'''
+        
+        if not getattr(source_constraints, 'vectorized', False):
+            return num.array([ bool(source_constraints(s)) for s in self ], dtype=num.bool)
+        
+        mask = num.asarray(source_constraints(self), dtype=num.bool)
+        if mask.shape != (len(self),):
+            raise Exception('vectorized source constraints must return one value per source')
+            
+        return mask
+    
+    def _source(self, i):
+        s = copy.copy(self.base_source)
+        s._params = dict(self.base_source._params)
+        for param, value in zip(self.params, self.values[i]):
+            s._params[param] = float(value)
+            
+        return s
+    
+def vectorized(source_constraints):
+    '''Mark source_constraints callback as taking a whole SourceGrid.
+    
+    Can be used as a decorator. See Source.grid().'''
+    
+    source_constraints.vectorized = True
+    return source_constraints
+
+def take_sources(sources, indices):
+    '''Get sources at given indices, from a list of sources or a SourceGrid.'''
+    
+    if isinstance(sources, SourceGrid):
+        return sources.take(indices)
+    
+    return [ sources[i] for i in indices ]
+
+def get_param_values(sources, param):
+    '''Get array with values of a parameter, from a list of sources or a SourceGrid.'''
+    
+    if isinstance(sources, SourceGrid):
+        return sources.get_values(param)
+    
+    return num.array([ source[param] for source in sources ], dtype=num.float)
+
 class SourceInfo:
     info = None
     info_flat = None